@@ -1,6 +1,25 @@
 
 import numpy as np
+import argparse
+import ast
+import bisect
+import glob
+import io
+import json
 import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array as compact_array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
+from itertools import chain
+from multiprocessing import shared_memory
 from PIL import Image
 
 NUM_CHANNELS = 3
@@ -8,91 +27,704 @@ NUM_CHANNELS = 3
 
 # --------------------------------------------------------------------------- #
 
-def img_read_helper(path):
+def img_read_helper(path, target_size=None, max_side=None):
     """
     Creates an RGBImage object from the given image file
+
+    To read a smaller image, pass either target_size as (rows, cols) or
+    max_side to shrink the image (keeping its aspect ratio) until neither
+    side is longer. JPEG files are then decoded at a reduced scale in the
+    DCT domain before the final resampling; other formats are decoded in
+    full and reduced with fast box filtering.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), 'wide.png')
+    >>> img_save_helper(path, RGBImage([[[0, 0, 0]] * 8] * 4))
+    >>> img_read_helper(path, max_side=4).size()
+    (2, 4)
+    >>> img_read_helper(path, target_size=(3, 3)).size()
+    (3, 3)
     """
+    if target_size is not None and max_side is not None:
+        raise ValueError()
+    img = Image.open(path)
+
+    if target_size is not None:
+        if not isinstance(target_size, tuple) or len(target_size) != 2 \
+        or not all(isinstance(side, int) for side in target_size):
+            raise TypeError()
+        if min(target_size) < 1:
+            raise ValueError()
+        num_rows, num_cols = target_size
+        # Let the decoder skip detail that the resize would throw away
+        img.draft("RGB", (num_cols, num_rows))
+        img = img.convert("RGB").resize((num_cols, num_rows), Image.Resampling.BOX,
+                                        reducing_gap=2.0)
+    elif max_side is not None:
+        if not isinstance(max_side, int):
+            raise TypeError()
+        if max_side < 1:
+            raise ValueError()
+        # thumbnail drafts JPEGs and never enlarges
+        img.draft("RGB", (max_side, max_side))
+        img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.Resampling.BOX, reducing_gap=2.0)
+
     # Open the image in RGB
-    img = Image.open(path).convert("RGB")
-    # Convert to numpy array and then to a list
-    matrix = np.array(img).tolist()
-    return RGBImage(matrix)
+    img = img.convert("RGB")
+    # Hand the decoded buffer straight to the image without going through
+    # lists; nothing else refers to it, so it needs no defensive copy
+    return RGBImage._from_trusted(np.asarray(img, dtype=np.uint8))
 
 
-def img_save_helper(path, image):
+def _ordered_map(executor, function, items, max_in_flight):
     """
-    Saves the given RGBImage instance to the given path
+    Yields function(item) for every item, in order, running them on the
+    executor with at most max_in_flight submitted but not yet yielded
     """
-    # Convert list to numpy array
-    img_array = np.array(image.get_pixels())
-    # Convert numpy array to PIL Image object
-    img = Image.fromarray(img_array.astype(np.uint8))
-    # Save the image object to path
-    img.save(path)
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
-# --------------------------------------------------------------------------- #
+def iter_read_images(paths, workers=None, max_in_flight=None,
+                     target_size=None, max_side=None):
+    """
+    Yields an RGBImage for each path, in order, decoding several files at
+    once on a pool of threads (PIL releases the GIL while decoding)
 
-# Part 1: RGB Image #passes terminal tests 
-class RGBImage:
+    At most max_in_flight images (2 * workers by default) are decoded ahead
+    of the one being consumed, which bounds memory use. target_size and
+    max_side are passed on to img_read_helper.
     """
-    Represents an image in RGB format
+    _check_workers(workers)
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    read = partial(img_read_helper, target_size=target_size, max_side=max_side)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        yield from _ordered_map(pool, read, paths, max_in_flight or 2 * workers)
+
+
+def img_read_many(paths, workers=None, max_in_flight=None,
+                  target_size=None, max_side=None):
     """
+    Returns a list with an RGBImage for each path, in the same order,
+    decoded concurrently (see iter_read_images)
+
+    >>> folder = tempfile.mkdtemp()
+    >>> paths = [os.path.join(folder, '%d.png' % i) for i in range(3)]
+    >>> for i, path in enumerate(paths):
+    ...     img_save_helper(path, RGBImage([[[i, i, i]]]))
+    >>> [img.get_pixel(0, 0) for img in img_read_many(paths, workers=2)]
+    [(0, 0, 0), (1, 1, 1), (2, 2, 2)]
+    """
+    return list(iter_read_images(paths, workers, max_in_flight, target_size, max_side))
 
-    def __init__(self, pixels): #passes terminal tests
-        """
-        Initializes a new RGBImage object
 
-        # Test with non-rectangular list
-        >>> pixels = [
-        ...              [[255, 255, 255], [255, 255, 255]],
-        ...              [[255, 255, 255]]
-        ...          ]
-        >>> RGBImage(pixels)
-        Traceback (most recent call last):
-        ...
-        TypeError
+def img_save_helper(path, image, format=None, **params):
+    """
+    Saves the given RGBImage (or GrayImage, as an 8-bit gray file)
+    instance to the given path
 
-        # Test instance variables
-        >>> pixels = [
-        ...              [[255, 255, 255], [0, 0, 0]]
-        ...          ]
-        >>> img = RGBImage(pixels)
-        >>> img.pixels
-        [[[255, 255, 255], [0, 0, 0]]]
-        >>> img.num_rows
-        1
-        >>> img.num_cols
-        2
-        """
+    format and any encoder params (e.g. compress_level for PNG, quality
+    for JPEG) are passed on to PIL; by default the format follows the
+    file extension.
+    """
+    # Convert the pixel buffer to a PIL Image object, laying out
+    # strided views (rotations, flips) contiguously first
+    img = Image.fromarray(np.ascontiguousarray(image.get_array()))
+    # Save the image object to path
+    img.save(path, format=format, **params)
 
-        # Raise exceptions here
-        # Check if pixels is a list and isn't empty
-        if not isinstance(pixels, list) or len(pixels) == 0:
+
+class AsyncImageWriter:
+    """
+    Saves images on background threads so that the caller can go on with
+    the next image while the previous one is encoded
+
+    submit() returns a concurrent.futures.Future (wrap it with
+    asyncio.wrap_future to await it) and blocks once max_pending saves
+    (2 * workers by default) are queued. flush() waits for every queued
+    save and raises the first error since the last flush; close(), or
+    leaving a with block, flushes and stops the threads.
+
+    >>> folder = tempfile.mkdtemp()
+    >>> with AsyncImageWriter(compress_level=1) as writer:
+    ...     future = writer.submit(os.path.join(folder, 'a.png'), RGBImage([[[1, 2, 3]]]))
+    >>> future.done(), img_read_helper(os.path.join(folder, 'a.png')).pixels
+    (True, [[[1, 2, 3]]])
+    >>> writer = AsyncImageWriter()
+    >>> _ = writer.submit(os.path.join(folder, 'missing', 'b.png'), RGBImage([[[0, 0, 0]]]))
+    >>> writer.close() # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    FileNotFoundError: [Errno 2] No such file or directory: ...
+    """
+    def __init__(self, workers=2, max_pending=None, format=None, compress_level=None):
+        """
+        Starts workers saving threads
+        """
+        _check_workers(workers)
+        _check_workers(max_pending)
+        workers = workers or 2
+        self.max_pending = max_pending or 2 * workers
+        self.format = format
+        self.params = {}
+        if compress_level is not None:
+            self.params["compress_level"] = compress_level
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.Semaphore(self.max_pending)
+        self._done = threading.Condition()
+        self._pending = set()
+        self._errors = []
+        self._closed = False
+
+    def submit(self, path, image):
+        """
+        Queues image to be saved to path and returns its future
+        """
+        if self._closed:
+            raise ValueError()
+        if not isinstance(image, _IMAGE_TYPES):
             raise TypeError()
+        # The copy shares the buffer read-only, so it stays as submitted
+        # even if the caller keeps modifying the image
+        image = image.copy()
+        self._slots.acquire()
+        future = self._pool.submit(img_save_helper, path, image, self.format, **self.params)
+        with self._done:
+            self._pending.add(future)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        """
+        Frees the slot of a finished save and records its error, if any
+        """
+        with self._done:
+            self._pending.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self._errors.append(future.exception())
+            self._done.notify_all()
+        self._slots.release()
+
+    def flush(self):
+        """
+        Waits for every queued save and raises the first error, if any
+        """
+        with self._done:
+            self._done.wait_for(lambda: not self._pending)
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
 
-        # Finding number of rows and columns
-        num_rows = len(pixels)
-        num_cols = len(pixels[0])
+    def close(self):
+        """
+        Flushes the queued saves and stops the threads
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the error already on its way out
+            self._closed = True
+            self._pool.shutdown(wait=True)
 
-        for row in pixels:
+
+def _pixels_to_array(pixels):
+    """
+    Converts a 3-dimensional list of intensities to a uint8 array, raising
+    TypeError for a malformed list and ValueError for a bad intensity
+    """
+    num_rows = len(pixels)
+    num_cols = len(pixels[0])
+
+    # Fast path: one structural pass, then a single vectorized
+    # shape/dtype/range check over all intensities
+    if all(isinstance(row, list) and len(row) == num_cols for row in pixels) \
+    and all(isinstance(pixel, list) and len(pixel) == NUM_CHANNELS
+            for row in pixels for pixel in row):
+        flat = list(chain.from_iterable(chain.from_iterable(pixels)))
+        # Only plain Python ints take the fast path; anything else (NumPy
+        # scalars included) is judged by the exact checks below
+        exact_ints = set(map(type, flat)) <= {int, bool}
+        flat = np.array(flat)
+        if exact_ints and flat.dtype.kind in "biu" and flat.size > 0 \
+        and flat.min() >= 0 and flat.max() <= 255:
+            return flat.astype(np.uint8).reshape(num_rows, num_cols, NUM_CHANNELS)
+
+    # Slow path: walk the intensities in order so that the first problem
+    # raises the same exception it always has
+    for row in pixels:
         # Check if each row is a list and if #row elements = #column elements
-            if not isinstance(row, list) or len(row) != num_cols:
+        if not isinstance(row, list) or len(row) != num_cols:
+            raise TypeError()
+
+        # Check if each pixel in each row is a list and each pixel len = 3
+        for pixel in row:
+            if not isinstance(pixel, list) or len(pixel) != 3:
                 raise TypeError()
-            
-            # Check if each pixel in each row is a list and each pixel len = 3
-            for pixel in row:
-                if not isinstance(pixel, list) or len(pixel) != 3:
-                    raise TypeError()
-            
-                # Check that each pixel value is an integer and lies b/w 0-255 range
-                for intensity in pixel:
-                    if not isinstance(intensity, int) or not (0 <= intensity <= 255):
-                        raise ValueError()
 
-        self.pixels = pixels
-        self.num_rows = num_rows
-        self.num_cols = num_cols
+            # Check that each pixel value is an integer and lies b/w 0-255 range
+            for intensity in pixel:
+                if not isinstance(intensity, int) or not (0 <= intensity <= 255):
+                    raise ValueError()
+
+    return np.array(pixels, dtype=np.uint8).reshape(num_rows, num_cols, NUM_CHANNELS)
+
+
+# --------------------------------------------------------------------------- #
+
+# Point operations: every output intensity depends only on the intensities of
+# the same pixel, so they run over the whole array at once. Per-intensity
+# operations are 256-entry lookup tables indexed by the uint8 buffer.
+
+def _negate_lut():
+    """
+    Returns the lookup table mapping x to 255 - x
+    """
+    return 255 - np.arange(256, dtype=np.uint8)
+
+
+def _brightness_lut(intensity):
+    """
+    Returns the lookup table mapping x to x + intensity clamped to 0-255
+    """
+    return np.clip(np.arange(256) + intensity, 0, 255).astype(np.uint8)
+
+
+def _apply_lut(array, lut):
+    """
+    Returns a new uint8 array with every intensity mapped through lut
+    """
+    return lut[array]
+
+
+def _average_brightness(array):
+    """
+    Returns the floored mean of all intensities of an array
+    """
+    total_brightness = int(array.sum(dtype=np.uint64))
+    return total_brightness // array.size
+
+
+def _gray_channel(array):
+    """
+    Returns the (rows, cols) array of sum(pixel) // 3 for a (rows, cols, 3)
+    array
+    """
+    return (array.sum(axis=2, dtype=np.uint16) // 3).astype(np.uint8)
+
+
+def _is_number(value):
+    """
+    Returns whether value is a real number (bools included, as in ==)
+    """
+    return isinstance(value, (int, float, np.integer, np.floating))
+
+
+def _chroma_mask(array, color, tolerance=0, distance=None):
+    """
+    Returns the (rows, cols) boolean array of the pixels of a (rows, cols, 3)
+    array that match color, within tolerance of it on every channel or, if
+    distance is given, within that Euclidean distance instead
+
+    A color that is not a tuple of NUM_CHANNELS numbers matches nothing,
+    just like comparing it with get_pixel would.
+    """
+    if _is_number(tolerance):
+        tolerance = (tolerance,) * NUM_CHANNELS
+    if not isinstance(tolerance, tuple) or len(tolerance) != NUM_CHANNELS \
+    or not all(_is_number(value) for value in tolerance):
+        raise TypeError()
+    if distance is not None and not _is_number(distance):
+        raise TypeError()
+    if min(tolerance) < 0 or (distance is not None and distance < 0):
+        raise ValueError()
+
+    if not isinstance(color, tuple) or len(color) != NUM_CHANNELS \
+    or not all(_is_number(value) for value in color):
+        return np.zeros(array.shape[:2], dtype=bool)
+    color = np.array(color)
+    if distance is not None:
+        offsets = array - color.astype(np.float64)
+        return np.einsum("ijk,ijk->ij", offsets, offsets) <= distance ** 2
+    if not any(tolerance):
+        return (array == color).all(axis=2)
+    return (np.abs(array - color.astype(np.float64)) <= np.array(tolerance)).all(axis=2)
+
+
+# --------------------------------------------------------------------------- #
+
+# Neighborhood operations
+
+BORDER_MODES = ("skip", "constant", "edge", "reflect")
+
+# Kernel used by edge_highlight
+LAPLACIAN_KERNEL = [
+    [-1, -1, -1],
+    [-1, 8, -1],
+    [-1, -1, -1]
+]
+
+
+def _integral_image(array):
+    """
+    Returns the summed-area table of an array: integral[i, j] is the sum
+    of array[:i, :j]
+    """
+    num_rows, num_cols = array.shape[:2]
+    integral = np.zeros((num_rows + 1, num_cols + 1) + array.shape[2:], dtype=np.int64)
+    np.cumsum(np.cumsum(array, axis=0, dtype=np.int64), axis=1, out=integral[1:, 1:])
+    return integral
+
+
+def _box_sums(array, row_radius, col_radius):
+    """
+    Returns the sums over the (2 * row_radius + 1) x (2 * col_radius + 1)
+    window around every pixel, with the window shrunk to the part inside the
+    image, along with the number of pixels in each window.
+
+    Window sums come from a summed-area table, so the cost per pixel does
+    not depend on the window size.
+    """
+    num_rows, num_cols = array.shape[:2]
+
+    integral = _integral_image(array)
+
+    # Window bounds, clipped to the image
+    top = np.maximum(np.arange(num_rows) - row_radius, 0)[:, np.newaxis]
+    bottom = np.minimum(np.arange(num_rows) + row_radius + 1, num_rows)[:, np.newaxis]
+    left = np.maximum(np.arange(num_cols) - col_radius, 0)
+    right = np.minimum(np.arange(num_cols) + col_radius + 1, num_cols)
+
+    sums = integral[bottom, right] - integral[top, right] \
+        - integral[bottom, left] + integral[top, left]
+    counts = (bottom - top) * (right - left)
+    if array.ndim == 3:
+        counts = counts[:, :, np.newaxis]
+    return sums, counts
+
+
+def _as_kernel(kernel):
+    """
+    Returns kernel as a 2-dimensional int64 or float64 array with odd sides
+    """
+    try:
+        kernel = np.asarray(kernel)
+    except ValueError:
+        raise TypeError()
+    if kernel.ndim != 2 or kernel.dtype.kind not in "biuf":
+        raise TypeError()
+    if kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+        raise ValueError()
+    if kernel.dtype.kind == "f":
+        return kernel.astype(np.float64)
+    return kernel.astype(np.int64)
+
+
+def _convolve(array, kernel, border="skip", normalize=False):
+    """
+    Applies kernel to the neighborhood of every pixel of a (rows, cols) or
+    (rows, cols, channels) array and returns the unclipped int64 (integer
+    kernel) or float64 (float kernel) result.
+
+    The kernel is applied as written: kernel[i][j] weights the pixel at
+    offset (i - kernel_rows // 2, j - kernel_cols // 2). Taps that fall
+    outside the image are handled according to border:
+
+    - "skip": the tap is left out
+    - "constant": the tap reads 0
+    - "edge": the tap reads the nearest border pixel
+    - "reflect": the tap reads the pixel mirrored about the border
+
+    With normalize, every result is divided by the total weight of the taps
+    that were used (floor division for integer kernels); a total weight of
+    zero anywhere is a ValueError.
+    """
+    kernel = _as_kernel(kernel)
+    if border not in BORDER_MODES:
+        raise ValueError()
+
+    num_rows, num_cols = array.shape[:2]
+    row_radius, col_radius = kernel.shape[0] // 2, kernel.shape[1] // 2
+    channel_axes = (np.newaxis,) * (array.ndim - 2)
+
+    if border in ("skip", "constant") and np.all(kernel == kernel.flat[0]):
+        # A uniform kernel is a scaled box sum
+        sums, counts = _box_sums(array, row_radius, col_radius)
+        result = sums * kernel.flat[0]
+        weights = counts * kernel.flat[0] if border == "skip" else kernel.sum()
+    else:
+        # Accumulate one shifted slice of the padded image per tap
+        pad = ((row_radius, row_radius), (col_radius, col_radius)) \
+            + ((0, 0),) * (array.ndim - 2)
+        if border in ("skip", "constant"):
+            padded = np.pad(array, pad, mode="constant")
+        else:
+            padded = np.pad(array, pad, mode=border)
+        result = np.zeros(array.shape, dtype=kernel.dtype)
+        for (i, j), weight in np.ndenumerate(kernel):
+            if weight:
+                result += weight * padded[i:i + num_rows, j:j + num_cols]
+
+        weights = kernel.sum()
+        if normalize and border == "skip":
+            # Total weight of the in-bounds taps around each pixel
+            inside = np.pad(np.ones((num_rows, num_cols), dtype=kernel.dtype), pad[:2])
+            weights = np.zeros((num_rows, num_cols), dtype=kernel.dtype)
+            for (i, j), weight in np.ndenumerate(kernel):
+                if weight:
+                    weights += weight * inside[i:i + num_rows, j:j + num_cols]
+            weights = weights[(Ellipsis,) + channel_axes]
+
+    if not normalize:
+        return result
+    if np.any(weights == 0):
+        raise ValueError()
+    if kernel.dtype.kind == "f":
+        return result / weights
+    return result // weights
+
+
+def _box_blur(array, radius):
+    """
+    Returns the floored mean of the (2 * radius + 1) square window around
+    every pixel, with the window shrunk to the part inside the image
+    """
+    window = np.ones((2 * radius + 1, 2 * radius + 1), dtype=np.int64)
+    return _convolve(array, window, border="skip", normalize=True).astype(np.uint8)
+
+
+def _filter(array, kernel, border="skip", normalize=False):
+    """
+    Returns the result of _convolve floored and clamped to 0-255 as uint8
+    """
+    filtered = _convolve(array, kernel, border, normalize)
+    return np.clip(np.floor(filtered), 0, 255).astype(np.uint8)
+
+
+def _edge_channel(gray):
+    """
+    Returns the Laplacian edge response of a (rows, cols) gray array,
+    clamped to 0-255
+    """
+    edges = _convolve(gray, LAPLACIAN_KERNEL, border="skip")
+    return np.clip(edges, 0, 255).astype(np.uint8)
+
+
+# --------------------------------------------------------------------------- #
+
+# Operations by name, used by pipelines. Each takes a (rows, cols, 3) array or
+# a (rows, cols) gray array plus the operation's arguments.
+
+# Operations that map each intensity through a lookup table
+_LUT_OPERATIONS = {
+    "negate": _negate_lut,
+    "adjust_brightness": _brightness_lut,
+}
+
+# Operations that look at more than one pixel or move pixels around
+_ARRAY_OPERATIONS = {
+    "blur": _box_blur,
+    "convolve": _filter,
+    "rotate_180": lambda array: array[::-1, ::-1],
+    "flip_horizontal": lambda array: array[:, ::-1],
+    "flip_vertical": lambda array: array[::-1],
+    "rotate_90": lambda array: np.rot90(array, k=-1),
+    "rotate_270": lambda array: np.rot90(array, k=1),
+}
+
+
+def _run_operations(array, operations):
+    """
+    Applies a list of (name, args) operations to an array, fusing runs of
+    point operations, and returns the result. The result is a (rows, cols)
+    array if the chain turned the image gray; it is up to the caller to
+    expand it back to three channels.
+    """
+    lut = None
+    for name, args in operations:
+        if name in _LUT_OPERATIONS:
+            # Compose with the pending table instead of touching the pixels
+            table = _LUT_OPERATIONS[name](*args)
+            lut = table if lut is None else table[lut]
+            continue
+
+        # Everything else needs the pending table applied first
+        if lut is not None:
+            array = _apply_lut(array, lut)
+            lut = None
+
+        if name == "grayscale":
+            # A gray array is already its own grayscale
+            if array.ndim == 3:
+                array = _gray_channel(array)
+        elif name == "edge_highlight":
+            if array.ndim == 3:
+                array = _gray_channel(array)
+            array = _edge_channel(array)
+        else:
+            array = _ARRAY_OPERATIONS[name](array, *args)
+
+    if lut is not None:
+        array = _apply_lut(array, lut)
+    return array
+
+
+def _halo(name, args):
+    """
+    Returns how many rows above and below a strip an operation reads
+    """
+    if name == "blur":
+        return args[0]
+    if name == "convolve":
+        return args[0].shape[0] // 2
+    if name == "edge_highlight":
+        return 1
+    return 0
+
+
+# --------------------------------------------------------------------------- #
+
+# Multi-core execution of neighborhood operations. The image is split into
+# horizontal bands; each worker process reads its band plus the halo rows
+# around it from shared memory and writes its rows of the result to shared
+# memory, so no pixel data is pickled.
+
+def _filter_band(source_name, source_shape, target_name, target_shape,
+                 operation, top, bottom):
+    """
+    Computes rows top to bottom of operation applied to the shared source
+    array and writes them to the shared target array
+    """
+    source_memory = shared_memory.SharedMemory(name=source_name)
+    target_memory = shared_memory.SharedMemory(name=target_name)
+    try:
+        source = np.ndarray(source_shape, dtype=np.uint8, buffer=source_memory.buf)
+        target = np.ndarray(target_shape, dtype=np.uint8, buffer=target_memory.buf)
+        halo = _halo(*operation)
+        start, stop = max(top - halo, 0), min(bottom + halo, source_shape[0])
+        band = _run_operations(source[start:stop], [operation])
+        target[top:bottom] = band[top - start:bottom - start]
+        del source, target, band
+    finally:
+        source_memory.close()
+        target_memory.close()
+
+
+def _check_workers(workers):
+    """
+    Checks that workers is None or a positive integer
+    """
+    if workers is not None and not isinstance(workers, int):
+        raise TypeError()
+    if workers is not None and workers < 1:
+        raise ValueError()
+
+
+# Arrays with fewer intensities than this are filtered in this process, as
+# handing them to other processes costs more than it saves
+PARALLEL_MIN_SIZE = 1 << 21
+
+# Process pools kept between calls, by number of workers
+_PROCESS_POOLS = {}
+
+
+def _process_pool(workers):
+    """
+    Returns a process pool with the given number of workers, starting it
+    on first use and reusing it afterwards
+    """
+    pool = _PROCESS_POOLS.get(workers)
+    if pool is None:
+        pool = _PROCESS_POOLS[workers] = ProcessPoolExecutor(max_workers=workers)
+    return pool
+
+
+def _parallel_filter(array, operation, workers=None):
+    """
+    Applies a (name, args) neighborhood operation that keeps the shape of
+    the array, splitting the rows over the given number of processes. The
+    result is identical to running the operation on the whole array.
+    Arrays smaller than PARALLEL_MIN_SIZE are filtered in this process.
+    """
+    _check_workers(workers)
+    num_rows = array.shape[0]
+    workers = min(workers or 1, num_rows)
+    if workers == 1 or array.size < PARALLEL_MIN_SIZE:
+        return _run_operations(array, [operation])
+
+    source_memory = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    target_memory = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    try:
+        source = np.ndarray(array.shape, dtype=np.uint8, buffer=source_memory.buf)
+        source[...] = array
+        bounds = np.linspace(0, num_rows, workers + 1).astype(int)
+        pool = _process_pool(workers)
+        bands = [
+            pool.submit(_filter_band, source_memory.name, array.shape,
+                        target_memory.name, array.shape, operation, top, bottom)
+            for top, bottom in zip(bounds[:-1], bounds[1:])
+        ]
+        try:
+            for band in bands:
+                band.result()
+        except BrokenProcessPool:
+            # Start a fresh pool next time
+            _PROCESS_POOLS.pop(workers, None)
+            raise
+        result = np.ndarray(array.shape, dtype=np.uint8, buffer=target_memory.buf).copy()
+        del source
+    finally:
+        source_memory.close()
+        source_memory.unlink()
+        target_memory.close()
+        target_memory.unlink()
+    return result
+
+
+# --------------------------------------------------------------------------- #
+
+# Pixel buffer shared by both image types #
+class _BaseImage:
+    """
+    Holds the uint8 pixel buffer of an image, (rows, cols, 3) for an
+    RGBImage and (rows, cols) for a GrayImage, and the methods that do
+    not depend on the number of channels
+    """
+
+    @classmethod
+    def _from_trusted(cls, array):
+        """
+        Wraps a uint8 array of the right shape for this image type,
+        produced by this library, without validating it again
+        """
+        image = cls.__new__(cls)
+        image._array = array
+        image.num_rows, image.num_cols = array.shape[:2]
+        return image
+
+    @property
+    def pixels(self):
+        """
+        The pixels of this image as a nested list: rows, then columns,
+        then (for an RGBImage) channels
+        """
+        return self._array.tolist()
 
     def size(self): #passes terminal tests
         """
@@ -110,7 +742,7 @@ class RGBImage:
 
     def get_pixels(self): #passes terminal tests
         """
-        Returns a copy of the image pixel array
+        Returns a copy of the image pixel array as a nested list
 
         # Make sure to complete __init__ first
         >>> pixels = [
@@ -129,13 +761,12 @@ class RGBImage:
         >>> id(pixels[0][0]) != id(img_pixels[0][0]) # Check pixel
         True
         """
-        return [[[pixel for pixel in channel] \
-        for channel in row] for row in self.pixels]
+        return self._array.tolist()
 
 
     def copy(self): #passes terminal tests
         """
-        Returns a copy of this RGBImage object
+        Returns a copy of this image, of the same type
 
         # Make sure to complete __init__ first
         >>> pixels = [
@@ -147,49 +778,177 @@ class RGBImage:
         # Check that this is a new instance
         >>> id(img_copy) != id(img)
         True
+
+        # The buffer is shared until one of the images is modified
+        >>> np.shares_memory(img.get_array(), img_copy.get_array())
+        True
+        >>> img_copy.set_pixel(0, 0, (0, 0, 0))
+        >>> np.shares_memory(img.get_array(), img_copy.get_array())
+        False
+        >>> img.get_pixel(0, 0)
+        (255, 255, 255)
+
+        # A GrayImage copies to a GrayImage
+        >>> gray = GrayImage([[1, 2]])
+        >>> gray_copy = gray.copy()
+        >>> gray_copy.set_pixel(0, 0, 9)
+        >>> type(gray_copy).__name__, gray.pixels, gray_copy.pixels
+        ('GrayImage', [[1, 2]], [[9, 2]])
         """
-        copied = self.get_pixels()
-        return RGBImage(copied)
+        return type(self)._from_trusted(self._share())
 
+    def _share(self):
+        """
+        Returns a read-only view of the pixel buffer that can back another
+        image. This image's own array is made read-only as well (including
+        for anyone holding it from get_array), so whichever side is
+        modified first copies the buffer (copy-on-write).
+        """
+        self._array.flags.writeable = False
+        return self._array.view()
 
-    def get_pixel(self, row, col): #passes terminal tests
+    def _make_writable(self):
         """
-        Returns the (R, G, B) value at the given position
+        Gives this image its own copy of the pixel buffer if it is
+        currently shared with another image
+        """
+        if not self._array.flags.writeable:
+            self._array = self._array.copy()
 
-        # Make sure to complete __init__ first
+
+# Part 1: RGB Image #passes terminal tests 
+class RGBImage(_BaseImage):
+    """
+    Represents an image in RGB format
+    """
+
+    def __init__(self, pixels): #passes terminal tests
+        """
+        Initializes a new RGBImage object
+
+        # Test with non-rectangular list
+        >>> pixels = [
+        ...              [[255, 255, 255], [255, 255, 255]],
+        ...              [[255, 255, 255]]
+        ...          ]
+        >>> RGBImage(pixels)
+        Traceback (most recent call last):
+        ...
+        TypeError
+
+        # Intensities must be Python ints
+        >>> RGBImage([[[np.int64(5), 0, 0]]])
+        Traceback (most recent call last):
+        ...
+        ValueError
+
+        # Test instance variables
         >>> pixels = [
         ...              [[255, 255, 255], [0, 0, 0]]
         ...          ]
         >>> img = RGBImage(pixels)
+        >>> img.pixels
+        [[[255, 255, 255], [0, 0, 0]]]
+        >>> img.num_rows
+        1
+        >>> img.num_cols
+        2
+        """
 
-        # Test with an invalid index
-        >>> img.get_pixel(1, 0)
+        # Raise exceptions here
+        # Check if pixels is a list and isn't empty
+        if not isinstance(pixels, list) or len(pixels) == 0:
+            raise TypeError()
+
+        array = _pixels_to_array(pixels)
+        self._array = array
+        self.num_rows, self.num_cols = array.shape[:2]
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        Creates an RGBImage object from a (rows, cols, 3) array of intensities
+
+        >>> img = RGBImage.from_array(np.zeros((2, 3, 3), dtype=np.uint8))
+        >>> img.size()
+        (2, 3)
+        >>> RGBImage.from_array(np.zeros((2, 3), dtype=np.uint8))
         Traceback (most recent call last):
         ...
-        ValueError
+        TypeError
 
-        # Run and check the returned value
+        # The image keeps its own copy of the array
+        >>> array = np.zeros((1, 1, 3), dtype=np.uint8)
+        >>> img = RGBImage.from_array(array)
+        >>> array[0, 0] = 9
         >>> img.get_pixel(0, 0)
-        (255, 255, 255)
+        (0, 0, 0)
         """
-        # Check that row and col are integers
-        if not isinstance(row, int) or not isinstance(col, int):
+        if not isinstance(array, np.ndarray) or array.ndim != 3 \
+        or array.shape[2] != NUM_CHANNELS or array.size == 0:
             raise TypeError()
-        # Check row/col index
-        if row < 0 or row >= self.num_rows or \
-        col < 0 or col >= self.num_cols:
+        if array.dtype != np.uint8:
             raise ValueError()
-        pixel = self.pixels[row][col]
-        return tuple(pixel)
-
 
+        return cls._from_trusted(np.array(array, order="C"))
 
-    def set_pixel(self, row, col, new_color): #passes terminal tests
+    def get_array(self):
         """
-        Sets the (R, G, B) value at the given position
+        Returns the (rows, cols, 3) uint8 array backing this image
 
-        # Make sure to complete __init__ first
-        >>> pixels = [
+        The array is read-only while the buffer is shared with a copy of
+        this image; use set_pixel to modify the image.
+
+        >>> img = RGBImage([[[255, 255, 255], [0, 0, 0]]])
+        >>> img.get_array().shape
+        (1, 2, 3)
+
+        # Copying freezes an array that was handed out earlier
+        >>> array = img.get_array()
+        >>> img_copy = img.copy()
+        >>> array.flags.writeable
+        False
+        """
+        return self._array
+
+    def get_pixel(self, row, col): #passes terminal tests
+        """
+        Returns the (R, G, B) value at the given position
+
+        # Make sure to complete __init__ first
+        >>> pixels = [
+        ...              [[255, 255, 255], [0, 0, 0]]
+        ...          ]
+        >>> img = RGBImage(pixels)
+
+        # Test with an invalid index
+        >>> img.get_pixel(1, 0)
+        Traceback (most recent call last):
+        ...
+        ValueError
+
+        # Run and check the returned value
+        >>> img.get_pixel(0, 0)
+        (255, 255, 255)
+        """
+        # Check that row and col are integers
+        if not isinstance(row, int) or not isinstance(col, int):
+            raise TypeError()
+        # Check row/col index
+        if row < 0 or row >= self.num_rows or \
+        col < 0 or col >= self.num_cols:
+            raise ValueError()
+        pixel = self._array[row, col]
+        return tuple(pixel.tolist())
+
+
+
+    def set_pixel(self, row, col, new_color): #passes terminal tests
+        """
+        Sets the (R, G, B) value at the given position
+
+        # Make sure to complete __init__ first
+        >>> pixels = [
         ...              [[255, 255, 255], [0, 0, 0]]
         ...          ]
         >>> img = RGBImage(pixels)
@@ -226,12 +985,269 @@ class RGBImage:
             if not isinstance(pixel_intensity, int):
                 raise TypeError()
         
-        original_color = self.pixels[row][col]
+        self._make_writable()
+        original_color = self._array[row, col].tolist()
         updated = [
             new_intensity if new_intensity >= 0 else current_intensity
             for current_intensity, new_intensity in zip(original_color, new_color)
         ]
-        self.pixels[row][col] = updated
+        self._array[row, col] = updated
+
+
+    def get_region(self, row, col, num_rows, num_cols):
+        """
+        Returns a new RGBImage with the num_rows x num_cols block of pixels
+        whose top left corner is at the given position
+
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]], [[3, 3, 3], [4, 4, 4]]])
+        >>> img.get_region(0, 1, 2, 1).pixels
+        [[[2, 2, 2]], [[4, 4, 4]]]
+        """
+        self._check_region(row, col, num_rows, num_cols)
+        return RGBImage._from_trusted(
+            self._array[row:row + num_rows, col:col + num_cols].copy())
+
+    def set_region(self, row, col, values, keep_negative=False):
+        """
+        Writes a block of pixels with its top left corner at the given
+        position. values is an RGBImage, a (rows, cols, 3) integer array
+        or a 3-dimensional list, checked once as a whole.
+
+        Intensities must be at most 255. With keep_negative=True a negative
+        intensity keeps the current value, as in set_pixel; otherwise it
+        is a ValueError.
+
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]], [[3, 3, 3], [4, 4, 4]]])
+        >>> img.set_region(1, 0, [[[9, -1, 9], [8, 8, 8]]], keep_negative=True)
+        >>> img.pixels
+        [[[1, 1, 1], [2, 2, 2]], [[9, 3, 9], [8, 8, 8]]]
+        """
+        values = self._bulk_values(values, keep_negative)
+        self._check_region(row, col, values.shape[0], values.shape[1])
+        self._make_writable()
+        region = self._array[row:row + values.shape[0], col:col + values.shape[1]]
+        self._write(region, values, keep_negative)
+
+    def set_masked(self, mask, values, keep_negative=False):
+        """
+        Writes the pixels where the boolean (rows, cols) mask is set, taking
+        them from values (an image-sized RGBImage, array or list) or setting
+        them all to one (R, G, B) color. keep_negative is as in set_region.
+
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]]])
+        >>> img.set_masked(np.array([[False, True]]), (0, -1, 7), keep_negative=True)
+        >>> img.pixels
+        [[[1, 1, 1], [0, 2, 7]]]
+        """
+        if not isinstance(mask, np.ndarray) or mask.dtype != bool:
+            raise TypeError()
+        if mask.shape != self.size():
+            raise ValueError()
+        if isinstance(values, tuple):
+            values = np.array([self._color_values(values, keep_negative)])
+        else:
+            values = self._bulk_values(values, keep_negative)
+            if values.shape[:2] != self.size():
+                raise ValueError()
+            values = values[mask]
+        self._make_writable()
+        region = self._array[mask]
+        self._write(region, values, keep_negative)
+        self._array[mask] = region
+
+    def fill(self, color, keep_negative=False):
+        """
+        Sets every pixel to the given (R, G, B) color. keep_negative is as
+        in set_region.
+
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]]])
+        >>> img.fill((5, -1, 5), keep_negative=True)
+        >>> img.pixels
+        [[[5, 1, 5], [5, 2, 5]]]
+        """
+        color = np.array(self._color_values(color, keep_negative))
+        self._make_writable()
+        self._write(self._array, color, keep_negative)
+
+    def _check_region(self, row, col, num_rows, num_cols):
+        """
+        Checks that a num_rows x num_cols block at the given position is
+        a non-empty part of this image
+        """
+        if not all(isinstance(value, int) for value in (row, col, num_rows, num_cols)):
+            raise TypeError()
+        if row < 0 or col < 0 or num_rows < 1 or num_cols < 1 \
+        or row + num_rows > self.num_rows or col + num_cols > self.num_cols:
+            raise ValueError()
+
+    @staticmethod
+    def _color_values(color, keep_negative):
+        """
+        Checks one (R, G, B) color as set_pixel does
+        """
+        if not isinstance(color, tuple) or len(color) != NUM_CHANNELS:
+            raise ValueError()
+        for intensity in color:
+            if intensity > 255:
+                raise ValueError()
+            if not isinstance(intensity, int):
+                raise TypeError()
+            if intensity < 0 and not keep_negative:
+                raise ValueError()
+        return color
+
+    @staticmethod
+    def _bulk_values(values, keep_negative):
+        """
+        Returns the pixels given to a bulk write as a checked (rows, cols, 3)
+        array
+        """
+        if isinstance(values, RGBImage):
+            return values.get_array()
+        if isinstance(values, list):
+            values = np.array(values, dtype=object)
+            if values.ndim != 3 or not all(isinstance(value, int) for value in values.flat):
+                raise TypeError()
+            values = values.astype(np.int64)
+        if not isinstance(values, np.ndarray) or not np.issubdtype(values.dtype, np.integer):
+            raise TypeError()
+        if values.ndim != 3 or values.shape[2] != NUM_CHANNELS or values.size == 0:
+            raise ValueError()
+        if values.dtype != np.uint8 and (values.max() > 255 or (values.min() < 0 and not keep_negative)):
+            raise ValueError()
+        return values
+
+    @staticmethod
+    def _write(region, values, keep_negative):
+        """
+        Writes checked values into a writable region of a pixel buffer
+        """
+        if keep_negative and np.issubdtype(values.dtype, np.signedinteger):
+            np.copyto(region, values, casting="unsafe", where=values >= 0)
+        else:
+            np.copyto(region, values, casting="unsafe")
+
+
+class GrayImage(_BaseImage):
+    """
+    Represents a grayscale image with one intensity per pixel
+
+    It stores a third of the data of an RGBImage with three equal
+    channels, and converts to one with to_rgb() when needed.
+
+    >>> img = GrayImage([[0, 128], [255, 64]])
+    >>> img.size(), img.get_pixel(0, 1)
+    ((2, 2), 128)
+    >>> img.to_rgb().pixels[0]
+    [[0, 0, 0], [128, 128, 128]]
+    >>> GrayImage([[0, 256]])
+    Traceback (most recent call last):
+    ...
+    ValueError
+
+    # The image processing methods keep a GrayImage gray
+    >>> img_proc = ImageProcessingTemplate()
+    >>> img_proc.negate(img).pixels
+    [[255, 127], [0, 191]]
+    >>> img_proc.rotate_90(img).pixels, img_proc.flip_horizontal(img).pixels
+    ([[255, 0], [64, 128]], [[128, 0], [64, 255]])
+    >>> img_proc.adjust_brightness(img, 10).pixels
+    [[10, 138], [255, 74]]
+    >>> img_proc.blur(img).pixels
+    [[111, 111], [111, 111]]
+    >>> type(img_proc.convolve(img, [[2]])).__name__
+    'GrayImage'
+    """
+
+    def __init__(self, pixels):
+        """
+        Initializes a new GrayImage object from a 2-dimensional list of
+        intensities
+        """
+        if not isinstance(pixels, list) or len(pixels) == 0 \
+        or not isinstance(pixels[0], list) or len(pixels[0]) == 0:
+            raise TypeError()
+        num_cols = len(pixels[0])
+        for row in pixels:
+            if not isinstance(row, list) or len(row) != num_cols:
+                raise TypeError()
+        flat = list(chain.from_iterable(pixels))
+        if not all(isinstance(intensity, int) and 0 <= intensity <= 255 for intensity in flat):
+            raise ValueError()
+
+        self._array = np.array(flat, dtype=np.uint8).reshape(len(pixels), num_cols)
+        self.num_rows, self.num_cols = self._array.shape
+
+    @classmethod
+    def from_array(cls, array):
+        """
+        Creates a GrayImage object from a (rows, cols) array of intensities
+        """
+        if not isinstance(array, np.ndarray) or array.ndim != 2 or array.size == 0:
+            raise TypeError()
+        if array.dtype != np.uint8:
+            raise ValueError()
+
+        # Keep a private copy so later writes to array do not leak in
+        return cls._from_trusted(np.array(array, order="C"))
+
+    def get_array(self):
+        """
+        Returns the (rows, cols) uint8 array backing this image, read-only
+        while it is shared with a copy
+        """
+        return self._array
+
+    def get_pixel(self, row, col):
+        """
+        Returns the intensity at the given position
+        """
+        if not isinstance(row, int) or not isinstance(col, int):
+            raise TypeError()
+        if row < 0 or row >= self.num_rows or col < 0 or col >= self.num_cols:
+            raise ValueError()
+        return int(self._array[row, col])
+
+    def set_pixel(self, row, col, new_intensity):
+        """
+        Sets the intensity at the given position; as in RGBImage.set_pixel
+        a negative intensity keeps the current value
+        """
+        if not isinstance(row, int) or not isinstance(col, int):
+            raise TypeError()
+        if row < 0 or row >= self.num_rows or col < 0 or col >= self.num_cols:
+            raise ValueError()
+        if not isinstance(new_intensity, int):
+            raise TypeError()
+        if new_intensity > 255:
+            raise ValueError()
+        if new_intensity >= 0:
+            self._make_writable()
+            self._array[row, col] = new_intensity
+
+    def to_rgb(self):
+        """
+        Returns an RGBImage with the intensity repeated on all three
+        channels, sharing this image's buffer until either is modified
+        """
+        gray = self._share()
+        return RGBImage._from_trusted(
+            np.broadcast_to(gray[:, :, np.newaxis], gray.shape + (NUM_CHANNELS,)))
+
+
+# Image types accepted where either kind of image will do
+_IMAGE_TYPES = (RGBImage, GrayImage)
+
+
+def _rgb_array(image):
+    """
+    Returns the (rows, cols, 3) pixels of an RGBImage or GrayImage, as a
+    broadcast view for a GrayImage
+    """
+    array = image.get_array()
+    if array.ndim == 2:
+        return np.broadcast_to(array[:, :, np.newaxis], array.shape + (NUM_CHANNELS,))
+    return array
 
 
 # Part 2: Image Processing Template Methods #
@@ -264,6 +1280,11 @@ class ImageProcessingTemplate:
         """
         return self.cost
 
+    def _charge(self, operation):
+        """
+        Charges for one call to the given operation (free in this tier)
+        """
+
     def negate(self, image):
         """
         Returns a negated copy of the given image
@@ -293,24 +1314,19 @@ class ImageProcessingTemplate:
         True
         >>> img_save_helper('img/out/gradient_16x16_negate.png', img_negate)# 6
         """
-        # Retrieve pixel matrix
-        pixels = image.get_pixels()
-        max_value = 255
-        
-        # Then calculate the negation values by subtracting it from the orginal matrix
-        negation = [[[max_value - intensity for intensity in pixel] \
-                    for pixel in row] for row in pixels]
-        
-        # negation = [[(255 - pixel[i]) for i in range(3) for pixel in pixels]]
-        
-        negated_img = RGBImage(negation)
+        # Look every intensity up in the 255 - x table
+        negation = _apply_lut(image.get_array(), _negate_lut())
+        negated_img = type(image)._from_trusted(negation)
         return negated_img
 
 
-    def grayscale(self, image): #passes terminal tests
+    def grayscale(self, image, single_channel=False): #passes terminal tests
         """
         Returns a grayscale copy of the given image
 
+        With single_channel=True the result is a GrayImage holding the
+        gray channel once instead of an RGBImage repeating it.
+
         # See negate for info on this test
         # You can view the output in the img/out/ directory
         >>> img_proc = ImageProcessingTemplate()
@@ -320,11 +1336,19 @@ class ImageProcessingTemplate:
         >>> img_gray.pixels == img_exp.pixels # Check grayscale output
         True
         >>> img_save_helper('img/out/gradient_16x16_gray.png', img_gray)
+
+        # Keep a single channel
+        >>> img_proc.grayscale(RGBImage([[[0, 10, 20]]]), single_channel=True).pixels
+        [[10]]
         """
-        pixels = image.get_pixels()
-        gray_pixels = [[[sum(pixel)//3] * 3 for pixel in row] for row in pixels]
-        grayed_image = RGBImage(gray_pixels)
-        return grayed_image
+        if isinstance(image, GrayImage):
+            grayed_image = image.copy()
+        else:
+            grayed_image = GrayImage._from_trusted(_gray_channel(image.get_array()))
+        if single_channel:
+            return grayed_image
+        # Share the single gray channel across all three channels
+        return grayed_image.to_rgb()
 
     def rotate_180(self, image): #passes terminal tests
         """
@@ -339,13 +1363,64 @@ class ImageProcessingTemplate:
         >>> img_rotate.pixels == img_exp.pixels # Check rotate_180 output
         True
         >>> img_save_helper('img/out/gradient_16x16_rotate.png', img_rotate)
+
+        # The result is a view of the same buffer until either is modified
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]], [[3, 3, 3], [4, 4, 4]]])
+        >>> img_rotate = img_proc.rotate_180(img)
+        >>> np.shares_memory(img.get_array(), img_rotate.get_array())
+        True
+        >>> img_rotate.set_pixel(0, 0, (0, 0, 0))
+        >>> img.get_pixel(1, 1)
+        (4, 4, 4)
         """
-        # Get new instance of og matrix
-        pixels = image.get_pixels()
-        transposed_pixels = [row[::-1] for row in pixels[::-1]]
-        flipped = RGBImage(transposed_pixels)
+        # Reverse the rows and the columns of a shared view
+        flipped = type(image)._from_trusted(image._share()[::-1, ::-1])
         return flipped
-        
+
+    def flip_horizontal(self, image):
+        """
+        Returns a copy of the given image mirrored left to right
+
+        >>> img_proc = ImageProcessingTemplate()
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]], [[3, 3, 3], [4, 4, 4]]])
+        >>> img_proc.flip_horizontal(img).pixels
+        [[[2, 2, 2], [1, 1, 1]], [[4, 4, 4], [3, 3, 3]]]
+        """
+        return type(image)._from_trusted(image._share()[:, ::-1])
+
+    def flip_vertical(self, image):
+        """
+        Returns a copy of the given image mirrored top to bottom
+
+        >>> img_proc = ImageProcessingTemplate()
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]], [[3, 3, 3], [4, 4, 4]]])
+        >>> img_proc.flip_vertical(img).pixels
+        [[[3, 3, 3], [4, 4, 4]], [[1, 1, 1], [2, 2, 2]]]
+        """
+        return type(image)._from_trusted(image._share()[::-1])
+
+    def rotate_90(self, image):
+        """
+        Returns a copy of the given image rotated 90 degrees clockwise
+
+        >>> img_proc = ImageProcessingTemplate()
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]], [[3, 3, 3], [4, 4, 4]]])
+        >>> img_proc.rotate_90(img).pixels
+        [[[3, 3, 3], [1, 1, 1]], [[4, 4, 4], [2, 2, 2]]]
+        """
+        return type(image)._from_trusted(np.rot90(image._share(), k=-1))
+
+    def rotate_270(self, image):
+        """
+        Returns a copy of the given image rotated 90 degrees counterclockwise
+
+        >>> img_proc = ImageProcessingTemplate()
+        >>> img = RGBImage([[[1, 1, 1], [2, 2, 2]], [[3, 3, 3], [4, 4, 4]]])
+        >>> img_proc.rotate_270(img).pixels
+        [[[2, 2, 2], [4, 4, 4]], [[1, 1, 1], [3, 3, 3]]]
+        """
+        return type(image)._from_trusted(np.rot90(image._share(), k=1))
+
 
     def get_average_brightness(self, image): #passes terminal tests
         """
@@ -361,10 +1436,7 @@ class ImageProcessingTemplate:
         # average_brightness = total_brightness // (image.num_rows + image.num_cols)
         # return average_brightness
 
-        pixels = image.get_pixels()
-        total_brightness = sum(sum(pixel) for row in pixels for pixel in row)
-        average_brightness = total_brightness // (3  * image.num_rows * image.num_cols)
-        return average_brightness
+        return _average_brightness(image.get_array())
 
 
     def adjust_brightness(self, image, intensity): #passes terminal tests
@@ -389,20 +1461,20 @@ class ImageProcessingTemplate:
         if intensity > bound_value or intensity < - bound_value:
             raise ValueError()
 
-        # Retrieve the pixel matrix 
-        pixels = image.get_pixels()
-
-        # Adjust the pixels
-        adjusted_pixels = [[[max(0, min(bound_value, pixel[i] + intensity)) \
-        for i in range(3)] for pixel in row] for row in pixels]
-        return RGBImage(adjusted_pixels)
+        # Adjust the pixels through a clamped x + intensity table
+        adjusted_pixels = _apply_lut(image.get_array(), _brightness_lut(intensity))
+        return type(image)._from_trusted(adjusted_pixels)
         
 
 
-    def blur(self, image):
+    def blur(self, image, radius=1, workers=None):
         """
         Returns a new image with the pixels blurred
 
+        Each pixel becomes the floored mean of the (2 * radius + 1) square
+        window around it, shrunk at the image borders. With workers > 1 the
+        rows are split over that many processes.
+
         >>> img_proc = ImageProcessingTemplate()
         >>> img = img_read_helper('img/gradient_16x16.png')
         >>> img_exp = img_read_helper('img/exp/gradient_16x16_blur.png')
@@ -410,373 +1482,1699 @@ class ImageProcessingTemplate:
         >>> img_adjust.pixels == img_exp.pixels # Check blur
         True
         >>> img_save_helper('img/out/gradient_16x16_blur.png', img_adjust)
-        """
-        pixels = image.get_pixels()
-        blurred_image = [[pixel for pixel in row] for row in pixels]
 
-        for row in range(image.num_rows):
-            for col in range(image.num_cols):
-                red_sum = 0
-                green_sum = 0
-                blue_sum = 0
-                counter = 0
+        # Check a wider window
+        >>> img = RGBImage([[[0, 0, 0], [30, 30, 30], [90, 90, 90]]])
+        >>> img_proc.blur(img).pixels
+        [[[15, 15, 15], [40, 40, 40], [60, 60, 60]]]
+        >>> img_proc.blur(img, radius=2).pixels
+        [[[40, 40, 40], [40, 40, 40], [40, 40, 40]]]
+
+        # Check that splitting the rows over processes gives the same result
+        >>> array = (np.arange(1024 * 1024 * 3) % 251).astype(np.uint8).reshape(1024, 1024, 3)
+        >>> img = RGBImage.from_array(array)
+        >>> np.array_equal(img_proc.blur(img, workers=2).get_array(), img_proc.blur(img).get_array())
+        True
+        """
+        # Check that radius is a non-negative integer
+        if not isinstance(radius, int):
+            raise TypeError()
+        if radius < 0:
+            raise ValueError()
 
-                for i in range(max(0, row-1), min(image.num_rows, row + 2)):
-                    for j in range(max(0, col-1), min(image.num_cols, col + 2)):
-                        red_sum += pixels[i][j][0]
-                        green_sum += pixels[i][j][1]
-                        blue_sum += pixels[i][j][2]
-                        counter += 1
+        blurred_image = _parallel_filter(image.get_array(), ("blur", (radius,)), workers)
+        return type(image)._from_trusted(blurred_image)
 
-                r_avg = red_sum // counter
-                g_avg = green_sum // counter
-                b_avg = blue_sum // counter
+    def convolve(self, image, kernel, border="skip", normalize=False, workers=None):
+        """
+        Returns a new image with the given kernel applied to every channel
 
-                blurred_image[row][col] = [r_avg, g_avg, b_avg]
+        The kernel is a 2-dimensional list (or array) of integers or floats
+        with an odd number of rows and columns. border is one of "skip",
+        "constant", "edge" or "reflect" (see _convolve). Results are
+        floored and clamped to 0-255. With workers > 1 the rows are split
+        over that many processes.
 
-        return RGBImage(blurred_image)
+        # Sharpen with replicated borders
+        >>> img_proc = ImageProcessingTemplate()
+        >>> img = RGBImage([[[10, 10, 10], [50, 50, 50], [10, 10, 10]]])
+        >>> sharpen = [[0, -1, 0], [-1, 5, -1], [0, -1, 0]]
+        >>> img_proc.convolve(img, sharpen, border="edge").pixels
+        [[[0, 0, 0], [130, 130, 130], [0, 0, 0]]]
 
+        # Test with an even-sized kernel
+        >>> img_proc.convolve(img, [[1, 1]])
+        Traceback (most recent call last):
+        ...
+        ValueError
 
-# Part 3: Standard Image Processing Methods # #passes terminal tests
-class StandardImageProcessing(ImageProcessingTemplate):
-    """
-    Represents a standard tier of an image processor
-    """
+        # Test normalizing by a zero total weight
+        >>> img_proc.convolve(img, LAPLACIAN_KERNEL, "edge", normalize=True)
+        Traceback (most recent call last):
+        ...
+        ValueError
+        """
+        kernel = _as_kernel(kernel)
+        if border not in BORDER_MODES:
+            raise ValueError()
+        operation = ("convolve", (kernel, border, normalize))
+        filtered = _parallel_filter(image.get_array(), operation, workers)
+        return type(image)._from_trusted(filtered)
 
-    def __init__(self):
+    def pipeline(self, image):
         """
-        Creates a new StandardImageProcessing object
+        Returns an ImagePipeline that records operations on the given image
+        and runs them all at once when computed
 
-        # Check that the cost was assigned
         >>> img_proc = ImageProcessingTemplate()
-        >>> img_proc.cost
-        0
+        >>> img = RGBImage([[[255, 255, 255], [0, 0, 0]]])
+        >>> pipeline = img_proc.pipeline(img).negate().adjust_brightness(10)
+        >>> pipeline.compute().pixels
+        [[[10, 10, 10], [255, 255, 255]]]
         """
-        super().__init__()
-        self.cost = 0
-        self.free = 0
+        return ImagePipeline(self, image)
 
-    def negate(self, image):
-        """
-        Returns a negated copy of the given image
 
-        # Check the expected cost
-        >>> img_proc = StandardImageProcessing()
-        >>> img_in = img_read_helper('img/square_16x16.png')
-        >>> negated = img_proc.negate(img_in)
-        >>> img_proc.get_cost()
-        5
+# Lazy pipelines of template operations #
+class ImagePipeline:
+    """
+    Records a chain of image processing operations and runs them in one go
+
+    Adjacent point operations (negate, grayscale, adjust_brightness) are
+    fused: consecutive intensity mappings are composed into one lookup
+    table, and everything after grayscale works on a single gray channel
+    until the end of the chain. No intermediate RGBImage is created. The
+    processor is charged for every recorded operation, in order, when the
+    pipeline is computed.
+    """
 
-        # Check that negate works the same as in the parent class
-        >>> img_proc = StandardImageProcessing()
-        >>> img = img_read_helper('img/gradient_16x16.png')
-        >>> img_exp = img_read_helper('img/exp/gradient_16x16_negate.png')
-        >>> img_negate = img_proc.negate(img)
-        >>> img_negate.pixels == img_exp.pixels # Check negate output
-        True
+    def __init__(self, processor, image):
         """
-        negated_image = super().negate(image)  
-        if self.free > 0:
-            self.cost += 0
-            self.free -= 1
-        else:
-            self.cost += 5
-        return negated_image
-
-    def grayscale(self, image):
+        Creates a new pipeline that starts from the given RGBImage or
+        GrayImage
         """
-        Returns a grayscale copy of the given image
+        if not isinstance(image, _IMAGE_TYPES):
+            raise TypeError()
+        self.processor = processor
+        self.image = image
+        self.operations = []
 
+    def _record(self, name, *args):
         """
-        grayed_img = super().grayscale(image)
-        if self.free > 0:
-            self.cost += 0
-            self.free -= 1
-        else:
-            self.cost += 6
-        return grayed_img
+        Adds an operation to the end of the chain and returns the pipeline
+        """
+        self.operations.append((name, args))
+        return self
 
-    def rotate_180(self, image):
+    def negate(self):
         """
-        Returns a rotated version of the given image
+        Records a negate operation
         """
-        rotated_img = super().rotate_180(image)
-        if self.free > 0:
-            self.cost += 0
-            self.free -= 1
-        else:
-            self.cost += 10
-        return rotated_img
+        return self._record("negate")
 
-
-    def adjust_brightness(self, image, intensity):
+    def grayscale(self):
         """
-        Returns a new image with adjusted brightness level
+        Records a grayscale operation
         """
-        adjusted_img = super().adjust_brightness(image)
-        if self.free > 0:
-            self.cost += 0
-            self.free -= 1
-        else:
-            self.cost += 1
-        return adjusted_img
+        return self._record("grayscale")
 
+    def adjust_brightness(self, intensity):
+        """
+        Records an adjust_brightness operation
+        """
+        # Check the intensity now, as the template method would
+        if not isinstance(intensity, int):
+            raise TypeError()
+        if intensity > 255 or intensity < -255:
+            raise ValueError()
+        return self._record("adjust_brightness", intensity)
 
-    def blur(self, image):
+    def blur(self, radius=1):
         """
-        Returns a new image with the pixels blurred
+        Records a blur operation
+        """
+        if not isinstance(radius, int):
+            raise TypeError()
+        if radius < 0:
+            raise ValueError()
+        return self._record("blur", radius)
+
+    def convolve(self, kernel, border="skip", normalize=False):
+        """
+        Records a convolve operation
+        """
+        kernel = _as_kernel(kernel)
+        if border not in BORDER_MODES:
+            raise ValueError()
+        return self._record("convolve", kernel, border, normalize)
+
+    def rotate_180(self):
+        """
+        Records a rotate_180 operation
+        """
+        return self._record("rotate_180")
+
+    def flip_horizontal(self):
+        """
+        Records a flip_horizontal operation
+        """
+        return self._record("flip_horizontal")
+
+    def flip_vertical(self):
+        """
+        Records a flip_vertical operation
+        """
+        return self._record("flip_vertical")
+
+    def rotate_90(self):
+        """
+        Records a rotate_90 operation
+        """
+        return self._record("rotate_90")
+
+    def rotate_270(self):
+        """
+        Records a rotate_270 operation
+        """
+        return self._record("rotate_270")
+
+    def edge_highlight(self):
+        """
+        Records an edge_highlight operation (premium processors only)
+        """
+        if not isinstance(self.processor, PremiumImageProcessing):
+            raise TypeError()
+        return self._record("edge_highlight")
+
+    def compute(self):
+        """
+        Runs the recorded operations and returns the resulting image, an
+        RGBImage or GrayImage like the one the pipeline started from
+
+        # Check that fused operations match the template methods
+        >>> img_proc = ImageProcessingTemplate()
+        >>> img = RGBImage([[[10, 20, 30], [200, 100, 0]]])
+        >>> fused = img_proc.pipeline(img).grayscale().negate().adjust_brightness(-5)
+        >>> steps = img_proc.adjust_brightness(img_proc.negate(img_proc.grayscale(img)), -5)
+        >>> fused.compute().pixels == steps.pixels
+        True
+
+        # Check that each operation is charged
+        >>> img_proc = StandardImageProcessing()
+        >>> img_proc.redeem_coupon(1)
+        >>> image = img_proc.pipeline(img).negate().grayscale().blur().compute()
+        >>> img_proc.get_cost()
+        11
+
+        # A GrayImage stays gray
+        >>> gray = GrayImage([[10, 200], [30, 40]])
+        >>> result = ImageProcessingTemplate().pipeline(gray).negate().rotate_90().compute()
+        >>> type(result).__name__, result.pixels
+        ('GrayImage', [[225, 245], [215, 55]])
+        """
+        array = _run_operations(self.image._share(), self.operations)
+        if array.ndim == 2 and isinstance(self.image, RGBImage):
+            array = np.broadcast_to(array[:, :, np.newaxis], array.shape + (NUM_CHANNELS,))
+
+        for name, args in self.operations:
+            self.processor._charge(name)
+
+        # Later operations continue from the computed image
+        self.image = type(self.image)._from_trusted(array)
+        self.operations = []
+        return self.image
+
+    def save(self, path):
+        """
+        Runs the recorded operations and saves the result to the given path
+        """
+        img_save_helper(path, self.compute())
+
+
+
+
+# Part 3: Standard Image Processing Methods # #passes terminal tests
+class StandardImageProcessing(ImageProcessingTemplate):
+    """
+    Represents a standard tier of an image processor
+    """
+
+    # Cost of one call to each operation
+    OPERATION_COSTS = {
+        "negate": 5,
+        "grayscale": 6,
+        "rotate_180": 10,
+        "flip_horizontal": 10,
+        "flip_vertical": 10,
+        "rotate_90": 10,
+        "rotate_270": 10,
+        "adjust_brightness": 1,
+        "blur": 5,
+        "convolve": 5,
+    }
+
+    def __init__(self):
+        """
+        Creates a new StandardImageProcessing object
+
+        # Check that the cost was assigned
+        >>> img_proc = ImageProcessingTemplate()
+        >>> img_proc.cost
+        0
+        """
+        super().__init__()
+        self.cost = 0
+        self.free = 0
+
+    def negate(self, image):
+        """
+        Returns a negated copy of the given image
+
+        # Check the expected cost
+        >>> img_proc = StandardImageProcessing()
+        >>> img_in = img_read_helper('img/square_16x16.png')
+        >>> negated = img_proc.negate(img_in)
+        >>> img_proc.get_cost()
+        5
+
+        # Check that negate works the same as in the parent class
+        >>> img_proc = StandardImageProcessing()
+        >>> img = img_read_helper('img/gradient_16x16.png')
+        >>> img_exp = img_read_helper('img/exp/gradient_16x16_negate.png')
+        >>> img_negate = img_proc.negate(img)
+        >>> img_negate.pixels == img_exp.pixels # Check negate output
+        True
+        """
+        negated_image = super().negate(image)  
+        self._charge("negate")
+        return negated_image
+
+    def grayscale(self, image, single_channel=False):
+        """
+        Returns a grayscale copy of the given image
+
+        """
+        grayed_img = super().grayscale(image, single_channel)
+        self._charge("grayscale")
+        return grayed_img
+
+    def rotate_180(self, image):
+        """
+        Returns a rotated version of the given image
+        """
+        rotated_img = super().rotate_180(image)
+        self._charge("rotate_180")
+        return rotated_img
+
+    def flip_horizontal(self, image):
+        """
+        Returns a copy of the given image mirrored left to right
+        """
+        rotated_img = super().flip_horizontal(image)
+        self._charge("flip_horizontal")
+        return rotated_img
+
+    def flip_vertical(self, image):
+        """
+        Returns a copy of the given image mirrored top to bottom
+        """
+        rotated_img = super().flip_vertical(image)
+        self._charge("flip_vertical")
+        return rotated_img
+
+    def rotate_90(self, image):
+        """
+        Returns a copy of the given image rotated 90 degrees clockwise
+        """
+        rotated_img = super().rotate_90(image)
+        self._charge("rotate_90")
+        return rotated_img
+
+    def rotate_270(self, image):
+        """
+        Returns a copy of the given image rotated 90 degrees counterclockwise
+        """
+        rotated_img = super().rotate_270(image)
+        self._charge("rotate_270")
+        return rotated_img
+
+
+    def adjust_brightness(self, image, intensity):
+        """
+        Returns a new image with adjusted brightness level
+        """
+        adjusted_img = super().adjust_brightness(image, intensity)
+        self._charge("adjust_brightness")
+        return adjusted_img
+
+
+    def blur(self, image, radius=1, workers=None):
+        """
+        Returns a new image with the pixels blurred
+        """
+        blurred_img = super().blur(image, radius, workers)
+        self._charge("blur")
+        return blurred_img
+
+
+    def convolve(self, image, kernel, border="skip", normalize=False, workers=None):
+        """
+        Returns a new image with the given kernel applied to every channel
+        """
+        filtered_img = super().convolve(image, kernel, border, normalize, workers)
+        self._charge("convolve")
+        return filtered_img
+
+
+    def _charge(self, operation):
+        """
+        Charges for one call to the given operation, using up a coupon
+        if one is available
         """
-        blurred_img = super().blur(image)
         if self.free > 0:
             self.cost += 0
             self.free -= 1
         else:
-            self.cost += 5
-        return blurred_img
+            self.cost += self.OPERATION_COSTS[operation]
+
+    def redeem_coupon(self, amount):
+        """
+        Makes the given number of methods calls free
+
+        # Check that the cost does not change for a call to negate
+        # when a coupon is redeemed
+        >>> img_proc = StandardImageProcessing()
+        >>> img = img_read_helper('img/gradient_16x16.png')
+        >>> img_proc.redeem_coupon(1)
+        >>> img = img_proc.rotate_180(img)
+        >>> img_proc.get_cost()
+        0
+        """
+        if amount <= 0:
+            raise ValueError()
+        if not isinstance(amount,int):
+            raise TypeError()
+        # for i in range(amount):
+        self.free += amount
+
+
+# Part 4: Premium Image Processing Methods #
+class PremiumImageProcessing(ImageProcessingTemplate):
+    """
+    Represents a paid tier of an image processor
+    """
+
+    def __init__(self):
+        """
+        Creates a new PremiumImageProcessing object
+
+        # Check the expected cost
+        >>> img_proc = PremiumImageProcessing()
+        >>> img_proc.get_cost()
+        50
+        """
+        super().__init__()
+        self.cost = 50
+
+    def chroma_key(self, chroma_image, background_image, color, tolerance=0,
+                   distance=None, mask=None, return_mask=False): #passes terminal tests
+        """
+        Returns a copy of the chroma image where all pixels with the given
+        color are replaced with the background image.
+
+        tolerance (a number or one per channel) also keys pixels that are
+        that close to color on every channel; distance, if given, keys the
+        pixels within that Euclidean distance instead. A boolean (rows, cols)
+        mask from an earlier call can be passed to skip the matching, and
+        return_mask=True returns (image, mask) for reuse across frames.
+
+        # Check the mask and the tolerance
+        >>> img_proc = PremiumImageProcessing()
+        >>> green = RGBImage([[[0, 255, 0], [10, 250, 5]]])
+        >>> back = RGBImage([[[1, 1, 1], [2, 2, 2]]])
+        >>> img_proc.chroma_key(green, back, (0, 255, 0)).pixels
+        [[[1, 1, 1], [10, 250, 5]]]
+        >>> keyed, mask = img_proc.chroma_key(green, back, (0, 255, 0), tolerance=10, return_mask=True)
+        >>> keyed.pixels, mask.tolist()
+        ([[[1, 1, 1], [2, 2, 2]]], [[True, True]])
+        >>> img_proc.chroma_key(green, back, None, mask=mask).pixels
+        [[[1, 1, 1], [2, 2, 2]]]
+        >>> img_proc.chroma_key(green, back, (0, 255, 0), distance=10).pixels
+        [[[1, 1, 1], [10, 250, 5]]]
+
+        # Check output
+        >>> img_proc = PremiumImageProcessing()
+        >>> img_in = img_read_helper('img/square_16x16.png')
+        >>> img_in_back = img_read_helper('img/gradient_16x16.png')
+        >>> color = (255, 255, 255)
+        >>> img_exp = img_read_helper('img/exp/square_16x16_chroma.png')
+        >>> img_chroma = img_proc.chroma_key(img_in, img_in_back, color)
+        >>> img_chroma.pixels == img_exp.pixels # Check chroma_key output
+        True
+        >>> img_save_helper('img/out/square_16x16_chroma.png', img_chroma)
+        """
+
+        if not isinstance(chroma_image, RGBImage) or not \
+            isinstance(background_image, RGBImage):
+            raise TypeError()
+
+        # Check image sizes
+        if chroma_image.size() != background_image.size():
+            raise ValueError()
+
+        if mask is None:
+            # Match every pixel against the color in one pass
+            mask = _chroma_mask(chroma_image.get_array(), color, tolerance, distance)
+        elif not isinstance(mask, np.ndarray) or mask.dtype != bool:
+            raise TypeError()
+        elif mask.shape != chroma_image.size():
+            raise ValueError()
+
+        # Take the background wherever the mask is set; the copy shares the
+        # buffer until something is written
+        new_image = chroma_image.copy()
+        if mask.any():
+            new_image.set_masked(mask, background_image)
+
+        if return_mask:
+            return new_image, mask
+        return new_image
+
+
+    def sticker(self, sticker_image, background_image, x_pos, y_pos, alpha=None): #passes terminal tests
+        """
+        Returns a copy of the background image where the sticker image is
+        placed at the given x and y position.
+
+        alpha, if given, blends the sticker over the background instead of
+        replacing it: either one opacity between 0 and 1, or a (rows, cols)
+        array the size of the sticker holding a boolean mask, opacities
+        between 0 and 1 (floats) or an 8-bit alpha channel (integers).
+
+        # Check blending
+        >>> img_proc = PremiumImageProcessing()
+        >>> back = RGBImage([[[0, 0, 0], [0, 0, 0], [0, 0, 0]]])
+        >>> badge = RGBImage([[[200, 100, 50], [200, 100, 50]]])
+        >>> img_proc.sticker(badge, back, 1, 0).pixels
+        [[[0, 0, 0], [200, 100, 50], [200, 100, 50]]]
+        >>> img_proc.sticker(badge, back, 0, 0, alpha=0.5).pixels
+        [[[100, 50, 25], [100, 50, 25], [0, 0, 0]]]
+        >>> img_proc.sticker(badge, back, 0, 0, alpha=np.array([[True, False]])).pixels
+        [[[200, 100, 50], [0, 0, 0], [0, 0, 0]]]
+
+        # Test with out-of-bounds image and position size
+        >>> img_proc = PremiumImageProcessing()
+        >>> img_sticker = img_read_helper('img/square_6x6.png')
+        >>> img_back = img_read_helper('img/gradient_16x16.png')
+        >>> x, y = (15, 0)
+        >>> img_proc.sticker(img_sticker, img_back, x, y)
+        Traceback (most recent call last):
+        ...
+        ValueError
+
+        # Check output
+        >>> img_proc = PremiumImageProcessing()
+        >>> img_sticker = img_read_helper('img/square_6x6.png')
+        >>> img_back = img_read_helper('img/gradient_16x16.png')
+        >>> x, y = (3, 3)
+        >>> img_exp = img_read_helper('img/exp/square_16x16_sticker.png')
+        >>> img_combined = img_proc.sticker(img_sticker, img_back, x, y)
+        >>> img_combined.pixels == img_exp.pixels # Check sticker output
+        True
+        >>> img_save_helper('img/out/square_16x16_sticker.png', img_combined)
+        """
+        alpha = self._check_sticker(sticker_image, background_image, x_pos, y_pos, alpha)
+
+        # Create a new image to store the result
+        new_image = background_image.copy()
+        self._paste(new_image, sticker_image, x_pos, y_pos, alpha)
+        return new_image
+
+
+    def place_stickers(self, background_image, placements):
+        """
+        Returns a copy of the background image with every sticker placed on
+        it, in order, so later stickers cover earlier ones
+
+        placements holds (sticker_image, x_pos, y_pos) or
+        (sticker_image, x_pos, y_pos, alpha) entries, as taken by sticker.
+        All of them are checked before anything is drawn, and the output
+        is allocated once.
+
+        >>> img_proc = PremiumImageProcessing()
+        >>> back = RGBImage([[[0, 0, 0]] * 3])
+        >>> dot = RGBImage([[[9, 9, 9]]])
+        >>> img_proc.place_stickers(back, [(dot, 0, 0), (dot, 2, 0, 0.5)]).pixels
+        [[[9, 9, 9], [0, 0, 0], [5, 5, 5]]]
+        """
+        if not isinstance(background_image, RGBImage):
+            raise TypeError()
+        checked = []
+        for placement in placements:
+            if not isinstance(placement, tuple) or len(placement) not in (3, 4):
+                raise TypeError()
+            sticker_image, x_pos, y_pos = placement[:3]
+            alpha = placement[3] if len(placement) == 4 else None
+            alpha = self._check_sticker(sticker_image, background_image, x_pos, y_pos, alpha)
+            checked.append((sticker_image, x_pos, y_pos, alpha))
+
+        # The shared buffer is copied once, on the first write
+        new_image = background_image.copy()
+        for sticker_image, x_pos, y_pos, alpha in checked:
+            self._paste(new_image, sticker_image, x_pos, y_pos, alpha)
+        return new_image
+
+
+    @staticmethod
+    def _check_sticker(sticker_image, background_image, x_pos, y_pos, alpha):
+        """
+        Checks a sticker placement as sticker does and returns its alpha as
+        None (opaque), a float or a (rows, cols) float array
+        """
+        # Checks that sticker_image and background_image are RGBImage instances
+        if not isinstance(sticker_image, RGBImage) or not \
+        isinstance(background_image, RGBImage):
+            raise TypeError() 
+
+        # Check sticker size smaller than background size
+        if (sticker_image.num_cols > background_image.num_cols
+            or sticker_image.num_rows > background_image.num_rows):
+            raise ValueError()
+
+        # Check x_pos and y_pos types
+        if not isinstance(x_pos, int) or not isinstance(y_pos, int):
+            raise TypeError()
+
+        # Check if sticker will fit at the x/y
+        if (sticker_image.num_rows + y_pos > background_image.num_rows
+            or sticker_image.num_cols + x_pos > background_image.num_cols
+            or x_pos < 0 or y_pos < 0):
+            raise ValueError()
+
+        if alpha is None:
+            return None
+        if _is_number(alpha) and not isinstance(alpha, (bool, np.bool_)):
+            if not 0 <= alpha <= 1:
+                raise ValueError()
+            return None if alpha == 1 else float(alpha)
+        if not isinstance(alpha, np.ndarray):
+            raise TypeError()
+        if alpha.shape != sticker_image.size():
+            raise ValueError()
+        if alpha.dtype == bool:
+            return alpha.astype(np.float64)
+        if np.issubdtype(alpha.dtype, np.integer):
+            if alpha.size and (alpha.min() < 0 or alpha.max() > 255):
+                raise ValueError()
+            return alpha / 255
+        if np.issubdtype(alpha.dtype, np.floating):
+            if alpha.size and not (0 <= alpha.min() and alpha.max() <= 1):
+                raise ValueError()
+            return alpha.astype(np.float64)
+        raise TypeError()
+
+
+    @staticmethod
+    def _paste(image, sticker_image, x_pos, y_pos, alpha):
+        """
+        Draws a checked sticker onto the image in place
+        """
+        if alpha is None:
+            image.set_region(y_pos, x_pos, sticker_image)
+            return
+        if not isinstance(alpha, float):
+            alpha = alpha[:, :, None]
+        region = image.get_region(y_pos, x_pos, *sticker_image.size()).get_array()
+        # Blend and round half up back to 8 bits
+        blended = sticker_image.get_array() * alpha + region * (1 - alpha) + 0.5
+        image.set_region(y_pos, x_pos, blended.astype(np.uint8))
+
+
+
+    def edge_highlight(self, image, workers=None):
+        """
+        Returns a new image with the edges highlighted
+
+        With workers > 1 the rows are split over that many processes. A
+        GrayImage is filtered directly and gives a GrayImage.
+
+        # Check output
+        >>> img_proc = PremiumImageProcessing()
+        >>> img = img_read_helper('img/gradient_16x16.png')
+        >>> img_edge = img_proc.edge_highlight(img)
+        >>> img_exp = img_read_helper('img/exp/gradient_16x16_edge.png')
+        >>> img_exp.pixels == img_edge.pixels # Check edge_highlight output
+        True
+        >>> img_save_helper('img/out/gradient_16x16_edge.png', img_edge)
+        """
+
+        # A GrayImage is filtered as is and stays gray
+        if isinstance(image, GrayImage):
+            edges = _parallel_filter(image.get_array(), ("edge_highlight", ()), workers)
+            return GrayImage._from_trusted(edges)
+
+        # Highlight edges on the gray channel and repeat it across R, G, B
+        gray = _gray_channel(image.get_array())
+        edges = _parallel_filter(gray, ("edge_highlight", ()), workers)
+        edge_img = np.broadcast_to(edges[:, :, np.newaxis], image.get_array().shape)
+        return RGBImage._from_trusted(edge_img)
+
+# img_proc = PremiumImageProcessing()
+# img = img_read_helper('img/gradient_16x16.png')
+# img_edge = img_proc.edge_highlight(img)
+# # for w in range(img.num_rows):
+# #     for h in range(img.num_cols):      
+# #         if sum(img.pixels[w][h]) != sum(img_edge.pixels[w][h]):
+# #             print(w, h)
+
+# img_exp = img_read_helper('img/exp/gradient_16x16_edge.png')
+# img_exp.pixels == img_edge.pixels
+# img_save_helper('img/out/gradient_16x16_edge.png', img_edge)
+
+
+# Streaming processing of images larger than memory #
+
+# Operations that can be recorded on a pipeline or listed for streaming
+PIPELINE_OPERATIONS = (
+    "negate", "grayscale", "adjust_brightness", "blur", "convolve",
+    "rotate_180", "flip_horizontal", "flip_vertical", "rotate_90",
+    "rotate_270", "edge_highlight"
+)
+
+# Operations that move pixels without changing them
+_GEOMETRIC_OPERATIONS = (
+    "rotate_180", "flip_horizontal", "flip_vertical", "rotate_90", "rotate_270"
+)
+
+# Operations that read a window of neighbors around each pixel
+_NEIGHBORHOOD_OPERATIONS = ("blur", "convolve", "edge_highlight")
+
+
+def _parse_operations(operations, processor=None):
+    """
+    Turns a list like ["grayscale", ("adjust_brightness", 40), "blur"] into
+    validated (name, args) pairs, raising the same exceptions as the
+    corresponding ImagePipeline methods
+    """
+    recorder = ImagePipeline.__new__(ImagePipeline)
+    recorder.processor = processor if processor is not None else PremiumImageProcessing()
+    recorder.operations = []
+    for operation in operations:
+        if isinstance(operation, str):
+            name, args = operation, ()
+        else:
+            name, args = operation[0], tuple(operation[1:])
+        if name not in PIPELINE_OPERATIONS:
+            raise ValueError()
+        getattr(recorder, name)(*args)
+    return recorder.operations
+
+
+def _plan_passes(operations):
+    """
+    Splits operations into passes over the image. Each pass reads its
+    source through the pass's geometric operations, then runs point
+    operations, at most one neighborhood operation and more point
+    operations. Point operations commute with moving pixels around, so
+    geometric operations are pulled to the front of their pass.
+    """
+    passes = []
+    current = None
+    for name, args in operations:
+        is_geometric = name in _GEOMETRIC_OPERATIONS
+        # Even a one-row kernel reads neighboring columns, so it does not
+        # commute with geometric operations; only a radius 0 blur does
+        is_filter = name in _NEIGHBORHOOD_OPERATIONS and not (name == "blur" and args[0] == 0)
+        # A pass cannot move pixels or run a second filter after its filter
+        if current is None or (current["filter"] is not None and (is_geometric or is_filter)):
+            current = {"geometric": [], "before": [], "filter": None, "after": []}
+            passes.append(current)
+        if is_geometric:
+            current["geometric"].append((name, args))
+        elif is_filter:
+            current["filter"] = (name, args)
+        elif current["filter"] is None:
+            current["before"].append((name, args))
+        else:
+            current["after"].append((name, args))
+    return passes
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Bytes per pixel of 8-bit PNG files by color type
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def _png_chunk(kind, data):
+    """
+    Returns a PNG chunk with its length and checksum
+    """
+    return struct.pack(">I", len(data)) + kind + data \
+        + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _unfilter_png_rows(header, palette, previous, rows):
+    """
+    Decodes the filtered bytes of consecutive PNG rows to a (rows, cols, 3)
+    array, returning it with the raw bytes of the last row
+
+    The rows are wrapped in a small stored PNG after the raw previous row,
+    which the filters may refer to, so that PIL undoes the filters in C.
+    """
+    width, num_rows, color_type = header
+    if previous is not None:
+        rows = b"\x00" + previous + rows
+        num_rows += 1
+    png = PNG_SIGNATURE \
+        + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, num_rows, 8, color_type, 0, 0, 0)) \
+        + (_png_chunk(b"PLTE", palette) if palette else b"") \
+        + _png_chunk(b"IDAT", zlib.compress(rows, 0)) + _png_chunk(b"IEND", b"")
+    with Image.open(io.BytesIO(png)) as img:
+        img.load()
+        last = np.asarray(img)[-1].tobytes()
+        strip = np.asarray(img.convert("RGB"))
+    return strip[1:] if previous is not None else strip, last
+
+
+def _decode_png_strips(path, scratch_dir, strip_rows):
+    """
+    Decodes a non-interlaced 8-bit PNG file strip_rows rows at a time into a
+    (rows, cols, 3) raw scratch memory map, or returns None if the file is
+    not such a PNG. Only a few strips are held in memory at once.
+    """
+    with open(path, "rb") as png:
+        if png.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            return None
+        length, kind = struct.unpack(">I4s", png.read(8))
+        if kind != b"IHDR" or length != 13:
+            return None
+        width, height, depth, color_type, _, _, interlace = \
+            struct.unpack(">IIBBBBB", png.read(13))
+        png.read(4)
+        if depth != 8 or interlace or color_type not in _PNG_CHANNELS:
+            return None
+
+        source = np.memmap(os.path.join(scratch_dir, "source.raw"), dtype=np.uint8,
+                           mode="w+", shape=(height, width, NUM_CHANNELS))
+        stride = 1 + width * _PNG_CHANNELS[color_type]
+        inflater = zlib.decompressobj()
+        pending = bytearray()
+        palette, previous, top = b"", None, 0
+
+        def drain():
+            nonlocal previous, top
+            while top < height and len(pending) >= stride * min(strip_rows, height - top):
+                count = min(strip_rows, height - top)
+                rows = bytes(pending[:count * stride])
+                del pending[:count * stride]
+                source[top:top + count], previous = _unfilter_png_rows(
+                    (width, count, color_type), palette, previous, rows)
+                top += count
+
+        while top < height:
+            header = png.read(8)
+            if len(header) < 8:
+                raise ValueError()
+            length, kind = struct.unpack(">I4s", header)
+            if kind == b"PLTE":
+                palette = png.read(length)
+            elif kind == b"IDAT":
+                remaining = length
+                while remaining:
+                    piece = png.read(min(remaining, 1 << 20))
+                    if not piece:
+                        raise ValueError()
+                    remaining -= len(piece)
+                    # Inflate at most a strip at a time, however well it compressed
+                    data = piece
+                    while data:
+                        pending += inflater.decompress(data, stride * strip_rows)
+                        data = inflater.unconsumed_tail
+                        drain()
+            else:
+                png.seek(length, 1)
+            png.read(4)
+    source.flush()
+    return source
+
+
+def _open_source(path, scratch_dir, strip_rows):
+    """
+    Returns a read-only (rows, cols, 3) uint8 memory map of the image at
+    path. .npy files are mapped directly and non-interlaced 8-bit PNG files
+    are decoded strip by strip; other formats are decoded whole by PIL once
+    and copied into a raw scratch file strip by strip.
+    """
+    if path.endswith(".npy"):
+        source = np.load(path, mmap_mode="r")
+        if source.ndim != 3 or source.shape[2] != NUM_CHANNELS or source.dtype != np.uint8:
+            raise ValueError()
+        return source
+
+    source = _decode_png_strips(path, scratch_dir, strip_rows)
+    if source is not None:
+        return source
+
+    with Image.open(path) as img:
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        num_cols, num_rows = img.size
+        source = np.memmap(os.path.join(scratch_dir, "source.raw"), dtype=np.uint8,
+                           mode="w+", shape=(num_rows, num_cols, NUM_CHANNELS))
+        for top in range(0, num_rows, strip_rows):
+            bottom = min(top + strip_rows, num_rows)
+            source[top:bottom] = np.asarray(img.crop((0, top, num_cols, bottom)))
+    source.flush()
+    return source
+
+
+def _write_png_strips(path, array, strip_rows):
+    """
+    Writes a (rows, cols, 3) uint8 array, typically memory-mapped, as an
+    RGB PNG file, compressing strip_rows rows at a time
+    """
+    def chunk(kind, data):
+        output.write(_png_chunk(kind, data))
+
+    num_rows, num_cols = array.shape[:2]
+    compressor = zlib.compressobj()
+    with open(path, "wb") as output:
+        output.write(PNG_SIGNATURE)
+        # 8 bits per channel, truecolor, no interlacing
+        chunk(b"IHDR", struct.pack(">IIBBBBB", num_cols, num_rows, 8, 2, 0, 0, 0))
+        for top in range(0, num_rows, strip_rows):
+            strip = np.asarray(array[top:top + strip_rows]).reshape(-1, num_cols * NUM_CHANNELS)
+            # Every row starts with filter type 0 (none)
+            rows = np.hstack((np.zeros((len(strip), 1), dtype=np.uint8), strip))
+            data = compressor.compress(rows.tobytes())
+            if data:
+                chunk(b"IDAT", data)
+        chunk(b"IDAT", compressor.flush())
+        chunk(b"IEND", b"")
+
+
+def stream_process(input_path, output_path, operations, strip_rows=256,
+                   processor=None, scratch_dir=None):
+    """
+    Runs a chain of operations over the image at input_path one strip of
+    rows at a time and writes the result to output_path
+
+    operations uses the names of the ImagePipeline methods, with arguments
+    in a tuple, e.g. ["grayscale", ("adjust_brightness", 40), "blur"].
+    Neighborhood operations read as many extra rows above and below each
+    strip as their window needs, so the output is identical to running the
+    same operations in memory. Intermediate results live in memory-mapped
+    raw files in scratch_dir (a temporary directory by default).
+
+    Only a few strips are held in memory at once when the input is a .npy
+    file (memory-mapped) or an 8-bit non-interlaced PNG (decoded strip by
+    strip) and the output is a .npy file (written beside output_path and
+    renamed over it at the end, so it may be the input too) or a PNG
+    (compressed strip by strip). Any other input format (JPEG, TIFF,
+    16-bit or interlaced PNG, ...) is decoded whole by PIL and any other
+    output format is encoded whole by PIL, so those are limited by memory.
+
+    If a processor is given it is charged for every operation, as
+    ImagePipeline.compute would.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), 'stream.png')
+    >>> img = RGBImage([[[10, 20, 30], [200, 100, 0]], [[0, 0, 0], [255, 255, 255]]])
+    >>> img_save_helper(path, img)
+    >>> stream_process(path, path, ['grayscale', ('adjust_brightness', 5), 'blur'], strip_rows=1)
+    >>> img_proc = ImageProcessingTemplate()
+    >>> img_exp = img_proc.blur(img_proc.adjust_brightness(img_proc.grayscale(img), 5))
+    >>> img_read_helper(path).pixels == img_exp.pixels
+    True
+    """
+    if not isinstance(strip_rows, int):
+        raise TypeError()
+    if strip_rows < 1:
+        raise ValueError()
+    operations = _parse_operations(operations, processor)
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch:
+        source = _open_source(input_path, scratch, strip_rows)
+        passes = _plan_passes(operations) or [{"geometric": [], "before": [],
+                                                "filter": None, "after": []}]
+
+        for index, stage in enumerate(passes):
+            # Read the source through the pass's geometric operations
+            view = _run_operations(source, stage["geometric"])
+            num_rows, num_cols = view.shape[:2]
+            halo = _halo(*stage["filter"]) if stage["filter"] else 0
+            last = index == len(passes) - 1
+
+            target = None
+            for top in range(0, num_rows, strip_rows):
+                bottom = min(top + strip_rows, num_rows)
+                start, stop = max(top - halo, 0), min(bottom + halo, num_rows)
+                strip = _run_operations(np.asarray(view[start:stop]), stage["before"])
+                if stage["filter"]:
+                    strip = _run_operations(strip, [stage["filter"]])
+                strip = _run_operations(strip[top - start:bottom - start], stage["after"])
+
+                if target is None:
+                    # Gray intermediates keep one channel; the result has three
+                    shape = (num_rows, num_cols)
+                    if last or strip.ndim == 3:
+                        shape += (NUM_CHANNELS,)
+                    if last and output_path.endswith(".npy"):
+                        # Written next to the output and renamed at the end,
+                        # so the output path may also be the input
+                        partial_path = output_path + ".partial"
+                        target = np.lib.format.open_memmap(partial_path, mode="w+",
+                                                           dtype=np.uint8, shape=shape)
+                    else:
+                        target = np.memmap(os.path.join(scratch, "pass%d.raw" % index),
+                                           dtype=np.uint8, mode="w+", shape=shape)
+                if strip.ndim < target.ndim:
+                    strip = strip[:, :, np.newaxis]
+                target[top:bottom] = strip
+            target.flush()
+            source = target
+
+        if output_path.endswith(".npy"):
+            del source, target, view
+            os.replace(partial_path, output_path)
+        elif output_path.lower().endswith(".png"):
+            _write_png_strips(output_path, source, strip_rows)
+        elif not output_path.endswith(".npy"):
+            num_rows, num_cols = source.shape[:2]
+            img = Image.frombuffer("RGB", (num_cols, num_rows), source, "raw", "RGB", 0, 1)
+            img.save(output_path)
+
+    if processor is not None:
+        for name, args in operations:
+            processor._charge(name)
+
+
+# Batch processing of image files #
+
+# Processor class used for each tier
+PROCESSOR_TIERS = {
+    "template": ImageProcessingTemplate,
+    "standard": StandardImageProcessing,
+    "premium": PremiumImageProcessing,
+}
+
+# Operations that combine the image with another image file
+_COMPOSITE_OPERATIONS = ("chroma_key", "sticker")
+
+
+def _resolve_inputs(inputs):
+    """
+    Returns the sorted list of files named by a directory, a glob pattern
+    or a list of paths
+    """
+    if isinstance(inputs, (list, tuple)):
+        return list(inputs)
+    if os.path.isdir(inputs):
+        return sorted(
+            os.path.join(inputs, name) for name in os.listdir(inputs)
+            if not name.startswith(".") and os.path.isfile(os.path.join(inputs, name))
+        )
+    return sorted(path for path in glob.glob(inputs) if os.path.isfile(path))
+
+
+def _parse_batch_operations(operations, tier):
+    """
+    Validates a batch operation chain and returns it as a list of
+    ("pipeline", [(name, args), ...]) and ("chroma_key"/"sticker", args)
+    steps
+    """
+    if tier not in PROCESSOR_TIERS:
+        raise ValueError()
+    processor = PROCESSOR_TIERS[tier]()
+    steps = []
+    for operation in operations:
+        name = operation if isinstance(operation, str) else operation[0]
+        args = () if isinstance(operation, str) else tuple(operation[1:])
+        if name in _COMPOSITE_OPERATIONS:
+            if not isinstance(processor, PremiumImageProcessing):
+                raise TypeError()
+            if name == "chroma_key" and len(args) != 2 or name == "sticker" and len(args) != 3:
+                raise ValueError()
+            steps.append((name, args))
+        else:
+            parsed = _parse_operations([operation], processor)
+            if steps and steps[-1][0] == "pipeline":
+                steps[-1][1].extend(parsed)
+            else:
+                steps.append(("pipeline", parsed))
+    return steps
+
+
+def _try_read(path):
+    """
+    Reads an image, returning the exception instead of raising it
+    """
+    try:
+        return img_read_helper(path)
+    except Exception as error:
+        return error
+
+
+@lru_cache(maxsize=8)
+def _read_overlay(path):
+    """
+    Reads a chroma key background or sticker once per process
+    """
+    return img_read_helper(path)
+
+
+def _output_paths(paths, output_dir):
+    """
+    Returns where batch_process saves each input: under its file name in
+    output_dir or, if two inputs share a file name, under its path
+    relative to the folder that holds all the inputs
+    """
+    names = [os.path.basename(path) for path in paths]
+    if len(set(names)) < len(names):
+        # Keep files from different folders apart
+        full_paths = [os.path.abspath(path) for path in paths]
+        root = os.path.commonpath([os.path.dirname(path) for path in full_paths])
+        names = [os.path.relpath(path, root) for path in full_paths]
+        if len(set(names)) < len(names):
+            # The same file was given twice
+            raise ValueError()
+    return [os.path.join(output_dir, name) for name in names]
+
+
+def _process_file(path, steps, output_path, tier, image=None, writer=None):
+    """
+    Runs a parsed batch chain on one file and saves the result, returning
+    a summary of the work. Errors are reported in the summary instead of
+    being raised, so one bad file does not stop the batch.
+
+    With a writer the save is only queued, and its future is left in the
+    summary under "saving".
+    """
+    result = {"input": path, "output": None, "cost": 0, "error": None}
+    try:
+        processor = PROCESSOR_TIERS[tier]()
+        starting_cost = processor.get_cost()
+        if image is None:
+            image = img_read_helper(path)
+        elif isinstance(image, Exception):
+            raise image
+        for name, args in steps:
+            if name == "pipeline":
+                pipeline = processor.pipeline(image)
+                for operation, operation_args in args:
+                    getattr(pipeline, operation)(*operation_args)
+                image = pipeline.compute()
+            elif name == "chroma_key":
+                image = processor.chroma_key(image, _read_overlay(args[0]), tuple(args[1]))
+            else:
+                image = processor.sticker(_read_overlay(args[0]), image, args[1], args[2])
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if writer is None:
+            img_save_helper(output_path, image)
+        else:
+            result["saving"] = writer.submit(output_path, image)
+        result["output"] = output_path
+        result["cost"] = processor.get_cost() - starting_cost
+    except Exception as error:
+        result["error"] = "%s: %s" % (type(error).__name__, error)
+    return result
+
+
+def _process_job(job, steps, tier):
+    """
+    Runs _process_file on an (input path, output path) pair in a worker
+    """
+    path, output_path = job
+    return _process_file(path, steps, output_path, tier)
+
+
+def batch_process(inputs, operations, output_dir, tier="standard",
+                  workers=None, progress=None):
+    """
+    Runs an operation chain over many image files and saves the results
+    under the same names in output_dir (keeping their folders relative to
+    the common folder of the inputs if two inputs share a name; giving the
+    same file twice is a ValueError)
+
+    inputs is a directory, a glob pattern or a list of paths. operations
+    uses the ImagePipeline names (see stream_process), plus
+    ("chroma_key", background_path, color) and
+    ("sticker", sticker_path, x_pos, y_pos) for the premium tier. Files
+    are processed by a pool of workers processes (all cores by default,
+    in this process if workers is 1), with a bounded number in flight.
+    A file that fails is reported and skipped. progress, if given, is
+    called as progress(done, total, result) in input order.
+
+    Returns a dict with the per-file "results", the number "failed" and
+    the total "cost" of the operations, charged as the tier's processor
+    would charge them one file at a time.
+
+    >>> folder = tempfile.mkdtemp()
+    >>> img_save_helper(os.path.join(folder, 'a.png'), RGBImage([[[10, 20, 30]]]))
+    >>> summary = batch_process(folder, ['negate', 'grayscale'], os.path.join(folder, 'out'), workers=1)
+    >>> summary['cost'], summary['failed']
+    (11, 0)
+    >>> img_read_helper(os.path.join(folder, 'out', 'a.png')).pixels
+    [[[235, 235, 235]]]
+    """
+    _check_workers(workers)
+    steps = _parse_batch_operations(operations, tier)
+    paths = _resolve_inputs(inputs)
+    output_paths = _output_paths(paths, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+
+    results = []
+
+    def report(result):
+        results.append(result)
+        if progress is not None:
+            progress(len(results), len(paths), result)
+
+    def finish(result):
+        saving = result.pop("saving", None)
+        try:
+            if saving is not None:
+                saving.result()
+        except Exception as error:
+            result.update(output=None, cost=0, error="%s: %s" % (type(error).__name__, error))
+        report(result)
+
+    if workers == 1:
+        # Decode the next files and encode the previous ones on threads
+        # while this one is processed
+        queued = deque()
+        writer = AsyncImageWriter()
+        try:
+            with ThreadPoolExecutor(max_workers=2) as readers:
+                images = _ordered_map(readers, _try_read, paths, 4)
+                for path, output_path, image in zip(paths, output_paths, images):
+                    queued.append(_process_file(path, steps, output_path, tier, image, writer))
+                    while len(queued) > writer.max_pending or (queued and "saving" not in queued[0]):
+                        finish(queued.popleft())
+                while queued:
+                    finish(queued.popleft())
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                # Each failed save is already reported with its file
+                pass
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Keep a bounded window of files in flight, reported in order
+            work = partial(_process_job, steps=steps, tier=tier)
+            jobs = zip(paths, output_paths)
+            for result in _ordered_map(pool, work, jobs, 2 * workers):
+                report(result)
+
+    return {
+        "results": results,
+        "failed": sum(1 for result in results if result["error"] is not None),
+        "cost": sum(result["cost"] for result in results),
+    }
+
+
+# Feature extractors for the KNN classifier #
+
+def thumbnail_features(image, size=(8, 8)):
+    """
+    Returns the image shrunk to a (rows, cols) thumbnail by averaging
+    each cell of a size[0] x size[1] grid, flattened to a uint8 vector
+
+    Each extractor gives a GrayImage the same features as its to_rgb(),
+    working on the single channel.
+
+    >>> img = RGBImage([[[0, 0, 0], [10, 10, 10]], [[20, 20, 20], [30, 30, 30]]])
+    >>> thumbnail_features(img, (1, 1)).tolist()
+    [15, 15, 15]
+    >>> thumbnail_features(GrayImage([[0, 10], [20, 30]]), (1, 1)).tolist()
+    [15, 15, 15]
+    """
+    array = image.get_array()
+    gray = array.ndim == 2
+    if gray:
+        array = array[:, :, np.newaxis]
+    num_rows, num_cols = array.shape[:2]
+    integral = _integral_image(array)
+
+    # Cell edges, with every cell at least one pixel wide
+    row_edges = np.linspace(0, num_rows, size[0] + 1).astype(int)
+    col_edges = np.linspace(0, num_cols, size[1] + 1).astype(int)
+    top = np.minimum(row_edges[:-1], num_rows - 1)[:, np.newaxis]
+    bottom = np.maximum(row_edges[1:], top[:, 0] + 1)[:, np.newaxis]
+    left = np.minimum(col_edges[:-1], num_cols - 1)
+    right = np.maximum(col_edges[1:], left + 1)
+
+    sums = integral[bottom, right] - integral[top, right] \
+        - integral[bottom, left] + integral[top, left]
+    counts = ((bottom - top) * (right - left))[:, :, np.newaxis]
+    cells = (sums // counts).astype(np.uint8)
+    if gray:
+        cells = np.repeat(cells, NUM_CHANNELS, axis=2)
+    return cells.reshape(-1)
+
+
+def histogram_features(image, bins=16):
+    """
+    Returns the per-channel intensity histograms of the image, each as
+    fractions of the pixel count, concatenated into a float32 vector
+
+    >>> img = RGBImage([[[0, 0, 255], [0, 255, 255]]])
+    >>> histogram_features(img, 2).tolist()
+    [1.0, 0.0, 0.5, 0.5, 0.0, 1.0]
+    """
+    array = image.get_array()
+    channels = 1 if array.ndim == 2 else NUM_CHANNELS
+    array = array.reshape(-1, channels)
+    buckets = (array.astype(np.int64) * bins) >> 8
+    offsets = np.arange(channels) * bins
+    counts = np.bincount((buckets + offsets).reshape(-1), minlength=bins * channels)
+    # A gray image has the same histogram on every channel
+    return np.tile(counts / len(array), NUM_CHANNELS // channels).astype(np.float32)
 
 
-    def redeem_coupon(self, amount):
-        """
-        Makes the given number of methods calls free
+def brightness_features(image):
+    """
+    Returns the average brightness (as get_average_brightness computes
+    it), the mean of each channel and the standard deviation of each
+    channel as a float32 vector
 
-        # Check that the cost does not change for a call to negate
-        # when a coupon is redeemed
-        >>> img_proc = StandardImageProcessing()
-        >>> img = img_read_helper('img/gradient_16x16.png')
-        >>> img_proc.redeem_coupon(1)
-        >>> img = img_proc.rotate_180(img)
-        >>> img_proc.get_cost()
-        0
-        """
-        if amount <= 0:
-            raise ValueError()
-        if not isinstance(amount,int):
-            raise TypeError()
-        # for i in range(amount):
-        self.free += amount
+    >>> img = RGBImage([[[0, 10, 20], [20, 30, 40]]])
+    >>> brightness_features(img).tolist()
+    [20.0, 10.0, 20.0, 30.0, 10.0, 10.0, 10.0]
+    """
+    array = image.get_array()
+    repeats = NUM_CHANNELS if array.ndim == 2 else 1
+    channels = array.reshape(array.shape[0] * array.shape[1], -1).astype(np.float64)
+    return np.concatenate((
+        [_average_brightness(array)],
+        np.tile(channels.mean(axis=0), repeats), np.tile(channels.std(axis=0), repeats)
+    )).astype(np.float32)
 
 
-# Part 4: Premium Image Processing Methods #
-class PremiumImageProcessing(ImageProcessingTemplate):
+# Built-in feature extractors by name
+FEATURE_EXTRACTORS = {
+    "thumbnail": thumbnail_features,
+    "histogram": histogram_features,
+    "brightness": brightness_features,
+}
+
+
+# Approximate nearest-neighbor index #
+class LSHIndex:
     """
-    Represents a paid tier of an image processor
+    Locality-sensitive hashing index over the rows of a feature matrix
+
+    Each of num_tables hash tables buckets the training rows by which side
+    of num_bits random hyperplanes (through the mean row) they fall on.
+    A query's candidates are the rows sharing its bucket in any table.
+    More tables raise recall; more bits make buckets smaller and queries
+    faster.
     """
 
-    def __init__(self):
+    def __init__(self, num_tables=8, num_bits=12, seed=0):
         """
-        Creates a new PremiumImageProcessing object
+        Creates a new, empty index
+        """
+        if not isinstance(num_tables, int) or not isinstance(num_bits, int):
+            raise TypeError()
+        if num_tables < 1 or not 1 <= num_bits <= 62:
+            raise ValueError()
+        self.num_tables = num_tables
+        self.num_bits = num_bits
+        self.seed = seed
+        self.tables = []
 
-        # Check the expected cost
-        >>> img_proc = PremiumImageProcessing()
-        >>> img_proc.get_cost()
-        50
+    def _hash(self, rows):
         """
-        super().__init__()
-        self.cost = 50
+        Returns the (rows, tables) bucket keys of a block of feature rows
+        """
+        projected = (rows.astype(np.float64) - self._mean) @ self._planes
+        bits = (projected > 0).reshape(len(rows), self.num_tables, self.num_bits)
+        return bits.astype(np.int64) @ (1 << np.arange(self.num_bits, dtype=np.int64))
 
-    def chroma_key(self, chroma_image, background_image, color): #passes terminal tests
+    def build(self, features):
         """
-        Returns a copy of the chroma image where all pixels with the given
-        color are replaced with the background image.
+        Hashes every row of the (rows, dimensions) feature matrix
+        """
+        random = np.random.default_rng(self.seed)
+        self._mean = features.mean(axis=0)
+        self._planes = random.standard_normal(
+            (features.shape[1], self.num_tables * self.num_bits))
 
-        # Check output
-        >>> img_proc = PremiumImageProcessing()
-        >>> img_in = img_read_helper('img/square_16x16.png')
-        >>> img_in_back = img_read_helper('img/gradient_16x16.png')
-        >>> color = (255, 255, 255)
-        >>> img_exp = img_read_helper('img/exp/square_16x16_chroma.png')
-        >>> img_chroma = img_proc.chroma_key(img_in, img_in_back, color)
-        >>> img_chroma.pixels == img_exp.pixels # Check chroma_key output
-        True
-        >>> img_save_helper('img/out/square_16x16_chroma.png', img_chroma)
+        self.tables = [{} for table in range(self.num_tables)]
+        self.add(features, 0)
+
+    def add(self, features, first_row):
+        """
+        Hashes more feature rows, numbered from first_row, into the
+        existing tables (the hyperplanes stay those chosen by build)
+        """
+        keys = np.empty((len(features), self.num_tables), dtype=np.int64)
+        block = max(1, (1 << 22) // max(1, features.shape[1]))
+        for start in range(0, len(features), block):
+            keys[start:start + block] = self._hash(features[start:start + block])
+
+        # Group row numbers by key in every table
+        for table, table_keys in zip(self.tables, keys.T):
+            order = np.argsort(table_keys, kind="stable")
+            unique, starts = np.unique(table_keys[order], return_index=True)
+            for key, rows in zip(unique.tolist(), np.split(order + first_row, starts[1:])):
+                table[key] = np.concatenate((table[key], rows)) if key in table else rows
+
+    def candidates(self, query):
+        """
+        Returns the sorted row numbers that share a bucket with the query
         """
+        keys = self._hash(query[np.newaxis])[0]
+        found = [table[key] for table, key in zip(self.tables, keys.tolist()) if key in table]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
 
-        if not isinstance(chroma_image, RGBImage) or not \
-            isinstance(background_image, RGBImage):
-            raise TypeError()
 
-        # Check image sizes
-        if chroma_image.size() != background_image.size():
-            raise ValueError()
+# Part 5: Image KNN Classifier #
 
-        # Create a new image to store the result
-        new_image = RGBImage(chroma_image.get_pixels())
+# First bytes of a file written by ImageKNNClassifier.save
+MODEL_MAGIC = b"KNNMODL1"
 
-        # Loop over each pixel in the chroma_image
-        for i in range(chroma_image.num_rows):
-            for j in range(chroma_image.num_cols):
-                # Get the pixel values from the chroma and background images
-                chroma_pixel = chroma_image.get_pixel(i, j)
-                background_pixel = background_image.get_pixel(i, j)
 
-                # Check if the pixel color matches the specified color
-                if chroma_pixel == color:
-                    # Replace the pixel with the corresponding pixel from the background image
-                    new_image.set_pixel(i, j, background_pixel)
+class ImageKNNClassifier:
+    """
+    Represents a simple KNNClassifier
+    """
 
-        return new_image
+    def __init__(self, k_neighbors, index=None, features=None):
+        """
+        Creates a new KNN classifier object
 
+        index is an optional approximate nearest-neighbor index (such as
+        LSHIndex) that is built at fit time and used by predict unless
+        exact=True is passed.
 
-    def sticker(self, sticker_image, background_image, x_pos, y_pos): #passes terminal tests
+        features selects what images are compared by: None compares every
+        raw pixel (images must all be the same size); a name from
+        FEATURE_EXTRACTORS or a function from an image to a 1-dimensional
+        array compares those feature vectors instead, which need not come
+        from same-sized images.
         """
-        Returns a copy of the background image where the sticker image is
-        placed at the given x and y position.
+        if isinstance(features, str):
+            if features not in FEATURE_EXTRACTORS:
+                raise ValueError()
+            features = FEATURE_EXTRACTORS[features]
+        if features is not None and not callable(features):
+            raise TypeError()
+        self.k_neighbors = k_neighbors
+        self.index = index
+        self.features = features
+        self.data = []
+        # Training images as rows of one matrix, with their squared norms
+        self._features = None
+        self._norms = None
+        self._labels = []
+        self._image_size = None
+        # Preallocated storage that partial_fit appends to
+        self._buffer = None
+        self._norm_buffer = None
+        # Plain Python training rows for predict_early_abandon, built lazily
+        self._python_rows = None
 
-        # Test with out-of-bounds image and position size
-        >>> img_proc = PremiumImageProcessing()
-        >>> img_sticker = img_read_helper('img/square_6x6.png')
-        >>> img_back = img_read_helper('img/gradient_16x16.png')
-        >>> x, y = (15, 0)
-        >>> img_proc.sticker(img_sticker, img_back, x, y)
+
+    def fit(self, data):
+        """
+        Stores the given set of data and labels for later
+
+        The training images (or their feature vectors) are stacked into one
+        matrix, so without a feature extractor they must all be images of
+        the same size. A GrayImage is compared as the RGBImage it converts
+        to.
+
+        >>> knn = ImageKNNClassifier(1)
+        >>> knn.fit([(RGBImage([[[0, 0, 0]]]), 'a'), (RGBImage([[[0, 0, 0], [0, 0, 0]]]), 'b')])
         Traceback (most recent call last):
         ...
         ValueError
-
-        # Check output
-        >>> img_proc = PremiumImageProcessing()
-        >>> img_sticker = img_read_helper('img/square_6x6.png')
-        >>> img_back = img_read_helper('img/gradient_16x16.png')
-        >>> x, y = (3, 3)
-        >>> img_exp = img_read_helper('img/exp/square_16x16_sticker.png')
-        >>> img_combined = img_proc.sticker(img_sticker, img_back, x, y)
-        >>> img_combined.pixels == img_exp.pixels # Check sticker output
-        True
-        >>> img_save_helper('img/out/square_16x16_sticker.png', img_combined)
         """
-        # Checks that sticker_image and background_image are RGBImage instances
-        if not isinstance(sticker_image, RGBImage) or not \
-        isinstance(background_image, RGBImage):
-            raise TypeError() 
-
-        # Check sticker size smaller than background size
-        if (sticker_image.num_cols > background_image.num_cols
-            or sticker_image.num_rows > background_image.num_rows):
+        if len(data) < self.k_neighbors:
             raise ValueError()
 
-        # Check x_pos and y_pos types
-        if not isinstance(x_pos, int) or not isinstance(y_pos, int):
+        images = [image for image, label in data]
+        if not all(isinstance(image, _IMAGE_TYPES) for image in images):
             raise TypeError()
-
-        # Check if sticker will fit at the x/y
-        if (sticker_image.num_rows + y_pos > background_image.num_rows
-            or sticker_image.num_cols + x_pos > background_image.num_cols):
+        if self.features is None and len(set(image.size() for image in images)) > 1:
             raise ValueError()
 
-        # Create a new image to store the result
-        new_image = RGBImage(background_image.get_pixels())
+        self.data = data
+        self._store(np.stack([self._vector(image) for image in images]),
+                    [label for image, label in data], images[0].size())
 
-        # Loop over each pixel in the sticker image
-        for i in range(sticker_image.num_rows):
-            for j in range(sticker_image.num_cols):
-                # Calculate the position in the background
-                back_row = y_pos + i
-                back_col = x_pos + j
 
-                # Get  pixel values from  sticker and background
-                sticker_pixel = sticker_image.get_pixel(i, j)
-                background_pixel = background_image.get_pixel(back_row, back_col)
+    def fit_matrix(self, features, labels, image_size, norms=None):
+        """
+        Stores a training set that is already a (images, pixels) uint8
+        matrix, such as the one load_training_set returns, without copying
+        it. Each row is an image of the given (rows, cols) size flattened
+        in (row, col, channel) order. norms, if given, are the rows' squared
+        lengths (as load_training_set(..., with_norms=True) returns them),
+        which saves reading the whole matrix; they are not used with a
+        feature extractor.
+        """
+        if len(labels) < self.k_neighbors:
+            raise ValueError()
+        if features.ndim != 2 or len(features) != len(labels) \
+        or features.shape[1] != image_size[0] * image_size[1] * NUM_CHANNELS:
+            raise ValueError()
 
-                # Replace corresponding pixels
-                new_image.set_pixel(back_row, back_col, sticker_pixel)
+        shape = tuple(image_size) + (NUM_CHANNELS,)
+        self.data = [(RGBImage._from_trusted(row.reshape(shape)), label)
+                     for row, label in zip(features, labels)]
+        if self.features is not None:
+            features = np.stack([self._vector(image) for image, label in self.data])
+            norms = None
+        elif norms is not None and np.shape(norms) != (len(features),):
+            raise ValueError()
+        self._store(features, labels, image_size, norms)
 
-        return new_image      
 
+    def _vector(self, image):
+        """
+        Returns the feature vector the classifier compares the image by
+        """
+        if self.features is None:
+            array = image.get_array()
+            if array.ndim == 2:
+                # Gray intensities repeated in (row, col, channel) order
+                return np.repeat(array.reshape(-1), NUM_CHANNELS)
+            return array.reshape(-1)
+        return np.asarray(self.features(image)).reshape(-1)
 
 
-    def edge_highlight(self, image):
+    def _store(self, features, labels, image_size, norms=None):
         """
-        Returns a new image with the edges highlighted
-        # Check output
-        >>> img_proc = PremiumImageProcessing()
-        >>> img = img_read_helper('img/gradient_16x16.png')
-        >>> img_edge = img_proc.edge_highlight(img)
-        >>> img_exp = img_read_helper('img/exp/gradient_16x16_edge.png')
-        >>> img_exp.pixels == img_edge.pixels # Check edge_highlight output
-        True
-        >>> img_save_helper('img/out/gradient_16x16_edge.png', img_edge)
+        Keeps the training matrix, its squared norms (computed unless
+        given) and the labels, and builds the index if there is one
         """
+        self._features = features
+        self._norms = self._squared_norms(features) if norms is None else norms
+        self._buffer = self._norm_buffer = None
+        self._labels = list(labels)
+        self._python_rows = None
+        # Only raw pixel vectors tie the queries to one image size
+        self._image_size = tuple(image_size) if self.features is None else None
+        if self.index is not None:
+            self.index.build(self._features)
+
+
+    def partial_fit(self, data):
+        """
+        Adds more (image, label) pairs to the training set
 
-        # Create a new image to store the result
-        edge_img = image.get_pixels()
-
-        for row in range(len(edge_img)):
-            for col in range(len(edge_img[0])):
-                avg = sum(edge_img[row][col])//3
-                edge_img[row][col] = avg        
-        output = []
-
-        # The kernel
-        kernel = [
-            [ -1, -1, -1],
-            [-1, 8, -1],
-            [-1, -1, -1]
-        ]
-        # Apply kernel to each pixel
-        for w in range(len(edge_img)):
-            new_lst = [0 for i in range(len(edge_img[0]))]
-            for h in range(len(edge_img[0])):
-
-                # Apply kernel to neighboring pixels
-                for i in range(-1, 2):
-                    for j in range(-1, 2):
-                        # Fact check that pixel is within image bounds
-                        if 0 <= w + i < len(edge_img) and 0 <= h + j < len(edge_img[0]):
-                            # pixel_pos = edge_img.get_pixel(w + i, h + j)
-                            m_value = kernel[i+1][j+1]
-                            # new_lst.append[pixel_pos[0]*m_value]
-                            new_lst[h] += edge_img[w+i][h+j] * m_value
-
-                if new_lst[h] < 0:
-                    new_lst[h] = [0, 0, 0]
-                elif new_lst[h] > 255:
-                    new_lst[h] = [255, 255, 255]
-                else:
-                    new_lst[h] = [new_lst[h], new_lst[h], new_lst[h]]
-
-
-                # if new_lst[h] < 0:
-                #     new_lst[h] = [0, 0, 0]
-                # else:
-                #     new_lst[h] = [255, 255, 255]
-
-            output.append(new_lst)
-        # print(output)
-        return RGBImage(output)
+        New feature vectors are appended to a preallocated buffer whose
+        capacity doubles when it fills up, so adding images one batch at a
+        time costs amortized constant time per image.
 
-# img_proc = PremiumImageProcessing()
-# img = img_read_helper('img/gradient_16x16.png')
-# img_edge = img_proc.edge_highlight(img)
-# # for w in range(img.num_rows):
-# #     for h in range(img.num_cols):      
-# #         if sum(img.pixels[w][h]) != sum(img_edge.pixels[w][h]):
-# #             print(w, h)
+        >>> knn = ImageKNNClassifier(2)
+        >>> knn.partial_fit([(RGBImage([[[0, 0, 0]]]), 'dark')])
+        >>> knn.partial_fit([(RGBImage([[[10, 10, 10]]]), 'dark'), (RGBImage([[[255, 255, 255]]]), 'light')])
+        >>> len(knn.data), knn.predict(RGBImage([[[5, 5, 5]]]))
+        (3, 'dark')
+        """
+        images = [image for image, label in data]
+        if not all(isinstance(image, _IMAGE_TYPES) for image in images):
+            raise TypeError()
+        if not images:
+            return
+        size = self._image_size if self._features is not None else images[0].size()
+        if self.features is None and any(image.size() != size for image in images):
+            raise ValueError()
 
-# img_exp = img_read_helper('img/exp/gradient_16x16_edge.png')
-# img_exp.pixels == img_edge.pixels
-# img_save_helper('img/out/gradient_16x16_edge.png', img_edge)
+        vectors = np.stack([self._vector(image) for image in images])
+        count = 0 if self._features is None else len(self._features)
+        capacity = 0 if self._buffer is None else len(self._buffer)
+        if self._features is not None and vectors.dtype != self._features.dtype:
+            raise ValueError()
 
+        if self._buffer is None:
+            # Stop sharing the list that was passed to fit
+            self.data = list(self.data)
+        if count + len(vectors) > capacity:
+            # Grow geometrically, keeping what is already there
+            capacity = max(count + len(vectors), 2 * capacity, 16)
+            buffer = np.empty((capacity, vectors.shape[1]), dtype=vectors.dtype)
+            norms = np.empty(capacity)
+            if count:
+                buffer[:count] = self._features
+                norms[:count] = self._norms
+            self._buffer, self._norm_buffer = buffer, norms
+
+        self._buffer[count:count + len(vectors)] = vectors
+        self._norm_buffer[count:count + len(vectors)] = self._squared_norms(vectors)
+        self._features = self._buffer[:count + len(vectors)]
+        self._norms = self._norm_buffer[:count + len(vectors)]
+        self._labels.extend(label for image, label in data)
+        if len(self.data) == count:
+            # A loaded model keeps no images, so data is only extended
+            # while it still matches the training matrix
+            self.data.extend(data)
+        self._python_rows = None
+        if self.features is None:
+            self._image_size = size
+        if self.index is not None:
+            if count and self.index.tables:
+                self.index.add(vectors, count)
+            else:
+                self.index.build(self._features)
 
-# Part 5: Image KNN Classifier #
-class ImageKNNClassifier:
-    """
-    Represents a simple KNNClassifier
-    """
 
-    def __init__(self, k_neighbors):
+    def save(self, path):
         """
-        Creates a new KNN classifier object
+        Saves the trained model (feature matrix, squared norms, labels and
+        k) to path in a compact binary format that load can memory-map
+
+        The file holds an 8-byte magic string, the length of a JSON header,
+        the header itself padded to a 64-byte boundary, the raw feature
+        matrix and then the float64 norms. A custom feature function cannot
+        be stored; pass it to load again. Labels go into the JSON header, so
+        they must be strings or integers (NumPy integers are stored as int)
+        to come back unchanged.
+
+        >>> knn = ImageKNNClassifier(1)
+        >>> knn.fit([(RGBImage([[[0, 0, 0]]]), ('dark', 1))])
+        >>> knn.save(os.path.join(tempfile.mkdtemp(), 'model.knn'))
+        Traceback (most recent call last):
+        ...
+        ValueError
         """
-        self.k_neighbors = k_neighbors
-        self.data = []
+        if self._features is None:
+            raise ValueError()
+        labels = [label.item() if isinstance(label, np.integer) else label
+                  for label in self._labels]
+        if not all(isinstance(label, (str, int)) for label in labels):
+            raise ValueError()
+        name = next((name for name, function in FEATURE_EXTRACTORS.items()
+                     if function is self.features), None)
+        header = json.dumps({
+            "k_neighbors": self.k_neighbors,
+            "dtype": self._features.dtype.str,
+            "shape": list(self._features.shape),
+            "labels": labels,
+            "image_size": self._image_size,
+            "features": name if self.features is None or name else "custom",
+        }).encode()
+        padding = -(len(MODEL_MAGIC) + 8 + len(header)) % 64
+        with open(path, "wb") as model_file:
+            model_file.write(MODEL_MAGIC)
+            model_file.write(np.uint64(len(header) + padding).tobytes())
+            model_file.write(header + b" " * padding)
+            model_file.write(np.ascontiguousarray(self._features).tobytes())
+            model_file.write(np.ascontiguousarray(self._norms, dtype=np.float64).tobytes())
+
+
+    @classmethod
+    def load(cls, path, index=None, features=None):
+        """
+        Loads a model written by save. The feature matrix and norms are
+        memory-mapped read-only, so loading is immediate and processes
+        serving the same file share its pages. The training images are
+        not kept as RGBImage objects, so data stays empty, also after
+        partial_fit.
+
+        >>> path = os.path.join(tempfile.mkdtemp(), 'model.knn')
+        >>> knn = ImageKNNClassifier(1)
+        >>> knn.fit([(RGBImage([[[0, 0, 0]]]), 'dark'), (RGBImage([[[255, 255, 255]]]), 'light')])
+        >>> knn.save(path)
+        >>> loaded = ImageKNNClassifier.load(path)
+        >>> loaded.predict(RGBImage([[[200, 200, 200]]]))
+        'light'
+        >>> loaded.predict_early_abandon(RGBImage([[[20, 20, 20]]]))
+        'dark'
+        """
+        with open(path, "rb") as model_file:
+            if model_file.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+                raise ValueError()
+            header_length = int(np.frombuffer(model_file.read(8), dtype=np.uint64)[0])
+            header = json.loads(model_file.read(header_length))
+        offset = len(MODEL_MAGIC) + 8 + header_length
+
+        if header["features"] == "custom":
+            if features is None:
+                raise ValueError()
+        elif header["features"] is not None:
+            features = header["features"]
+        model = cls(header["k_neighbors"], index=index, features=features)
+
+        dtype, shape = np.dtype(header["dtype"]), tuple(header["shape"])
+        model._features = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+        model._norms = np.memmap(path, dtype=np.float64, mode="r", shape=(shape[0],),
+                                 offset=offset + dtype.itemsize * shape[0] * shape[1])
+        model._labels = header["labels"]
+        if header["image_size"] is not None:
+            model._image_size = tuple(header["image_size"])
+        if index is not None:
+            index.build(model._features)
+        return model
+
+
+    @staticmethod
+    def _squared_norms(features):
+        """
+        Returns the squared length of every row of a feature matrix
+        """
+        dtype = np.float64 if features.dtype.kind == "f" else np.int64
+        norms = np.empty(len(features))
+        # Widen a block of rows at a time, as _squared_distances does
+        block = max(1, (1 << 23) // max(1, features.shape[1]))
+        for start in range(0, len(features), block):
+            wide = features[start:start + block].astype(dtype)
+            norms[start:start + block] = np.einsum("ij,ij->i", wide, wide)
+        return norms
 
 
-    def fit(self, data):
+    def _squared_distances(self, queries, rows=None):
         """
-        Stores the given set of data and labels for later
+        Returns the (queries, training images) matrix of squared Euclidean
+        distances between the rows of queries and the training matrix, or
+        only the given training rows
+
+        Uses |a - b|^2 = |a|^2 + |b|^2 - 2 a.b with one matrix product per
+        block of training rows. Every term is an integer below 2^53, so the
+        float64 results are exact.
         """
-        if len(data) < self.k_neighbors:
-            raise ValueError()
-        self.data = data
+        features, norms = self._features, self._norms
+        if rows is not None:
+            features, norms = features[rows], norms[rows]
+        queries = queries.astype(np.float64)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        distances = np.empty((len(queries), len(features)))
+
+        # Widen the compact training matrix one block at a time
+        block = max(1, (1 << 23) // max(1, features.shape[1]))
+        for start in range(0, len(features), block):
+            wide = features[start:start + block].astype(np.float64)
+            distances[:, start:start + block] = query_norms[:, np.newaxis] \
+                + norms[np.newaxis, start:start + block] - 2 * (queries @ wide.T)
+        return distances
 
 
     def distance(self, image1, image2): #passes terminal tests
@@ -791,7 +3189,7 @@ class ImageKNNClassifier:
         """
 
         # Check if both images are RGBImage instances
-        if not isinstance(image1, RGBImage) or not isinstance(image2, RGBImage):
+        if not isinstance(image1, _IMAGE_TYPES) or not isinstance(image2, _IMAGE_TYPES):
             raise TypeError()
 
         # Check that both image sizes are equal
@@ -799,11 +3197,8 @@ class ImageKNNClassifier:
             raise ValueError()
 
         # Calculate the sum of the squared differences
-        euc_dist = (sum(
-            ((image1.get_pixel(i, j)[x] - image2.get_pixel(i, j)[x]) ** 2)
-            for i in range(image1.num_rows)
-            for j in range(image1.num_cols)
-            for x in range(3)))**(0.5)
+        difference = _rgb_array(image1).astype(np.int64) - _rgb_array(image2)
+        euc_dist = int(np.einsum("ijk,ijk->", difference, difference))**(0.5)
        
         return euc_dist
 
@@ -829,23 +3224,344 @@ class ImageKNNClassifier:
         return popular
 
 
-    def predict(self, image):
+    def predict(self, image, exact=False):
         """
         Predicts the label of the given image using the labels of
         the K closest neighbors to this image
 
+        With an index, the neighbors are searched approximately unless
+        exact is True.
+
         The test for this method is located in the knn_tests method below
         """
-        if not self.data:
+        if self._features is None or len(self._labels) < self.k_neighbors:
+            raise ValueError()
+        if not isinstance(image, _IMAGE_TYPES):
+            raise TypeError()
+        if self._image_size is not None and image.size() != self._image_size:
+            raise ValueError()
+
+        query = self._vector(image)[np.newaxis]
+        nearest = self._nearest(query, exact)[0]
+        knn = [self._labels[i] for i in nearest]
+        prediction = self.vote(knn)
+        return prediction
+
+
+    def predict_batch(self, images, exact=False):
+        """
+        Predicts the label of every image in the given list, as predict
+        would, and returns the labels in the same order
+
+        Distances are computed for a block of queries at a time, so memory
+        stays bounded however many images are passed in.
+
+        >>> knn = ImageKNNClassifier(1)
+        >>> knn.fit([(RGBImage([[[0, 0, 0]]]), 'dark'), (RGBImage([[[255, 255, 255]]]), 'light')])
+        >>> knn.predict_batch([RGBImage([[[20, 20, 20]]]), RGBImage([[[200, 200, 200]]])])
+        ['dark', 'light']
+        """
+        if self._features is None or len(self._labels) < self.k_neighbors:
+            raise ValueError()
+        for image in images:
+            if not isinstance(image, _IMAGE_TYPES):
+                raise TypeError()
+            if self._image_size is not None and image.size() != self._image_size:
+                raise ValueError()
+
+        predictions = []
+        # Bound both the widened queries and their rows of distances
+        block = max(1, (1 << 22) // max(len(self._features), self._features.shape[1]))
+        for start in range(0, len(images), block):
+            queries = np.stack([self._vector(image) for image in images[start:start + block]])
+            for nearest in self._nearest(queries, exact):
+                predictions.append(self.vote([self._labels[i] for i in nearest]))
+        return predictions
+
+
+    def predict_early_abandon(self, image):
+        """
+        Predicts the label of the given image like predict, with a plain
+        Python search that avoids whole-matrix arithmetic
+
+        Training images are visited in order of how close their total
+        brightness is to the query's. The squared distance of the current
+        k-th best neighbor bounds the search: a training image stops being
+        summed as soon as its partial squared distance exceeds the bound,
+        and the search ends once the brightness difference alone (which
+        bounds the distance from below) exceeds it. The result is the same
+        as predict's exhaustive search for pixel, thumbnail or other
+        integer features.
+
+        >>> knn = ImageKNNClassifier(1)
+        >>> knn.fit([(RGBImage([[[0, 0, 0]]]), 'dark'), (RGBImage([[[255, 255, 255]]]), 'light')])
+        >>> knn.predict_early_abandon(RGBImage([[[200, 200, 200]]]))
+        'light'
+        """
+        if self._features is None or len(self._labels) < self.k_neighbors:
+            raise ValueError()
+        if not isinstance(image, _IMAGE_TYPES):
+            raise TypeError()
+        if self._image_size is not None and image.size() != self._image_size:
             raise ValueError()
 
-        distance = [(self.distance(image, training), label) for training, label in self.data]
-        distance.sort(key=lambda x: x[0])
-        knn = [label for i, label in distance[:self.k_neighbors]]
+        if self._python_rows is None:
+            # Plain Python copies of the training vectors and their sums
+            self._python_rows = [self._python_vector(row) for row in self._features]
+            self._python_sums = [sum(row) for row in self._python_rows]
+        rows, sums = self._python_rows, self._python_sums
+        query = self._python_vector(self._vector(image))
+        query_sum = sum(query)
+        length = len(query)
+
+        # Best (distance, index) pairs so far, sorted
+        best = []
+        bound = None
+        for index in sorted(range(len(rows)), key=lambda i: abs(sums[i] - query_sum)):
+            # |a - b|^2 >= (sum(a) - sum(b))^2 / length, and later images
+            # only differ more in brightness
+            if bound is not None and (sums[index] - query_sum) ** 2 > bound * length:
+                break
+
+            row = rows[index]
+            partial = 0
+            for start in range(0, length, 256):
+                stop = start + 256
+                partial += sum((a - b) * (a - b) for a, b in zip(query[start:stop], row[start:stop]))
+                if bound is not None and partial > bound:
+                    break
+            else:
+                bisect.insort(best, (partial, index))
+                if len(best) > self.k_neighbors:
+                    best.pop()
+                if len(best) == self.k_neighbors:
+                    bound = best[-1][0]
+
+        knn = [self._labels[index] for distance, index in best]
         prediction = self.vote(knn)
         return prediction
 
 
+    @staticmethod
+    def _python_vector(vector):
+        """
+        Returns a feature vector as a compact sequence of Python numbers
+        """
+        if vector.dtype == np.uint8:
+            return compact_array("B", vector.tobytes())
+        return vector.tolist()
+
+
+    def _nearest(self, queries, exact=False):
+        """
+        Returns the indices of the k nearest training images for every row
+        of queries, through the index unless exact is True or there is none
+        """
+        if exact or self.index is None:
+            return self._k_nearest(self._squared_distances(queries))
+
+        nearest = []
+        for query in queries:
+            # Rank the index's candidates exactly; candidates are in
+            # training order, so ties still break as in the exact search
+            rows = self.index.candidates(query)
+            if len(rows) < self.k_neighbors:
+                nearest.append(self._k_nearest(self._squared_distances(query[np.newaxis]))[0])
+            else:
+                distances = self._squared_distances(query[np.newaxis], rows)
+                nearest.append(rows[self._k_nearest(distances)[0]])
+        return nearest
+
+
+    def index_recall(self, images):
+        """
+        Compares the index against the exact search on the given query
+        images and returns a report with the mean fraction of the true k
+        nearest neighbors the index found ("recall"), the mean number of
+        candidates it ranked ("candidates") and the time each search took
+        ("approximate_seconds", "exact_seconds")
+
+        >>> knn = ImageKNNClassifier(2, index=LSHIndex(num_tables=4, num_bits=2))
+        >>> knn.fit([(RGBImage([[[v, v, v]]]), 'a') for v in range(0, 250, 10)])
+        >>> report = knn.index_recall([RGBImage([[[v, 0, v]]]) for v in range(0, 250, 25)])
+        >>> 0 <= report['recall'] <= 1
+        True
+        """
+        if self._features is None or self.index is None:
+            raise ValueError()
+        queries = np.stack([self._vector(image) for image in images])
+
+        start = time.perf_counter()
+        approximate = self._nearest(queries)
+        approximate_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        exact = self._nearest(queries, exact=True)
+        exact_seconds = time.perf_counter() - start
+
+        found = [len(set(a.tolist()) & set(e.tolist())) / len(e) for a, e in zip(approximate, exact)]
+        candidates = [len(self.index.candidates(query)) for query in queries]
+        return {
+            "recall": float(np.mean(found)),
+            "candidates": float(np.mean(candidates)),
+            "approximate_seconds": approximate_seconds,
+            "exact_seconds": exact_seconds,
+        }
+
+
+    def _k_nearest(self, distances):
+        """
+        Returns, for every row of a distance matrix, the indices of the
+        k_neighbors smallest distances ordered by distance and then by
+        training order (the order a stable sort of all distances gives)
+
+        The k smallest are found with a partial selection; only rows where
+        a tie straddles the k-th place fall back to a full stable sort.
+        """
+        k = self.k_neighbors
+        if k >= distances.shape[1]:
+            return np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        chosen = np.take_along_axis(distances, nearest, axis=1)
+
+        # Rows where the k-th distance is shared with an image left out
+        kth = chosen.max(axis=1)[:, np.newaxis]
+        tied = (distances == kth).sum(axis=1) > (chosen == kth).sum(axis=1)
+        if tied.any():
+            nearest[tied] = np.argsort(distances[tied], axis=1, kind="stable")[:, :k]
+            chosen = np.take_along_axis(distances, nearest, axis=1)
+
+        order = np.lexsort((nearest, chosen), axis=1)
+        return np.take_along_axis(nearest, order, axis=1)
+
+
+
+def _training_files(path):
+    """
+    Returns (file path, label) for every image in the label sub-folders
+    of path, in directory listing order. Hidden entries are skipped.
+    """
+    files = []
+    for label in os.listdir(path):
+        label_path = os.path.join(path, label)
+        # Ignore non-folder and hidden items
+        if label.startswith(".") or not os.path.isdir(label_path):
+            continue
+        for img_file in os.listdir(label_path):
+            if not img_file.startswith("."):
+                files.append((os.path.join(label_path, img_file), label))
+    return files
+
+
+def load_training_set(path="knn_data", cache_dir=None, with_norms=False):
+    """
+    Reads a labelled training set (one sub-folder per label) and returns
+    (features, labels, image_size) for ImageKNNClassifier.fit_matrix, or
+    (features, labels, image_size, norms) with the rows' squared lengths
+    if with_norms is true
+
+    The decoded pixels and their norms are cached in cache_dir
+    (path/.cache by default) as features-<generation>.npy and
+    norms-<generation>.npy, with a manifest.json naming them and recording
+    each file's path, size, modification time and label. Later calls
+    decode only the files that were added or changed, and when nothing
+    changed both are memory-mapped straight from disk.
+
+    >>> folder = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(folder, 'dark'))
+    >>> img_save_helper(os.path.join(folder, 'dark', 'a.png'), RGBImage([[[5, 5, 5]]]))
+    >>> features, labels, image_size = load_training_set(folder)
+    >>> features.tolist(), labels, image_size
+    ([[5, 5, 5]], ['dark'], (1, 1))
+    >>> isinstance(load_training_set(folder)[0], np.memmap)
+    True
+    >>> load_training_set(folder, with_norms=True)[3].tolist()
+    [75.0]
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(path, ".cache")
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+
+    # Entries of the previous run, keyed by file path
+    cached, old_features, old_norms = {}, None, None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        old_path = os.path.join(cache_dir, manifest.get("features", ""))
+        if manifest.get("features") and os.path.exists(old_path):
+            cached = {entry["path"]: entry for entry in manifest["entries"]}
+            old_features = np.load(old_path, mmap_mode="r")
+            norms_path = os.path.join(cache_dir, manifest.get("norms", ""))
+            if manifest.get("norms") and os.path.exists(norms_path):
+                old_norms = np.load(norms_path, mmap_mode="r")
+
+    entries, rows, missing = [], [], []
+    for file_path, label in _training_files(path):
+        stat = os.stat(file_path)
+        entry = {"path": file_path, "size": stat.st_size,
+                 "mtime_ns": stat.st_mtime_ns, "label": label}
+        old = cached.get(file_path)
+        if old is not None and all(old[key] == entry[key] for key in entry):
+            rows.append(old["row"])
+        else:
+            rows.append(None)
+            missing.append(len(entries))
+        entries.append(entry)
+
+    labels = [entry["label"] for entry in entries]
+    if not missing and old_norms is not None and rows == list(range(len(old_features))):
+        # Nothing changed: serve the cached matrix and norms from disk
+        if with_norms:
+            return old_features, labels, tuple(manifest["image_size"]), old_norms
+        return old_features, labels, tuple(manifest["image_size"])
+
+    # Decode only the new or changed files
+    decoded = dict(zip(missing, iter_read_images(entries[index]["path"] for index in missing)))
+    sizes = set(image.size() for image in decoded.values())
+    if old_features is not None and len(rows) > len(missing):
+        sizes.add(tuple(manifest["image_size"]))
+    if len(sizes) != 1:
+        raise ValueError()
+    image_size = sizes.pop()
+
+    features = np.empty((len(entries), image_size[0] * image_size[1] * NUM_CHANNELS),
+                        dtype=np.uint8)
+    for index, row in enumerate(rows):
+        if row is None:
+            features[index] = decoded[index].get_array().reshape(-1)
+        else:
+            features[index] = old_features[row]
+    for index, entry in enumerate(entries):
+        entry["row"] = index
+    del old_features, old_norms
+    norms = ImageKNNClassifier._squared_norms(features)
+
+    # The arrays go to new files named by the manifest, and replacing the
+    # manifest is the single atomic step that switches to them, so a
+    # crash leaves either the old cache or the new one
+    os.makedirs(cache_dir, exist_ok=True)
+    generation = os.urandom(8).hex()
+    features_name, norms_name = "features-%s.npy" % generation, "norms-%s.npy" % generation
+    for name, array in ((features_name, features), (norms_name, norms)):
+        with open(os.path.join(cache_dir, name), "wb") as array_file:
+            np.save(array_file, array)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump({"features": features_name, "norms": norms_name,
+                   "image_size": image_size, "entries": entries}, manifest_file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    # Drop arrays no manifest refers to any more
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy") and name not in (features_name, norms_name):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                # Still mapped elsewhere on some platforms; removed next time
+                pass
+    if with_norms:
+        return features, labels, image_size, norms
+    return features, labels, image_size
+
 
 def knn_tests(test_img_path):
     """
@@ -855,26 +3571,16 @@ def knn_tests(test_img_path):
     'nighttime'
     """
     # Read all of the sub-folder names in the knn_data folder
-    # These will be treated as labels
+    # These will be treated as labels. Decoded images are cached on disk,
+    # so only new or changed images are read again
     path = 'knn_data'
-    data = []
-    for label in os.listdir(path):
-        label_path = os.path.join(path, label)
-        # Ignore non-folder items
-        if not os.path.isdir(label_path):
-            continue
-        # Read in each image in the sub-folder
-        for img_file in os.listdir(label_path):
-            train_img_path = os.path.join(label_path, img_file)
-            img = img_read_helper(train_img_path)
-            # Add the image object and the label to the dataset
-            data.append((img, label))
+    features, labels, image_size, norms = load_training_set(path, with_norms=True)
 
     # Create a KNN-classifier using the dataset
     knn = ImageKNNClassifier(5)
 
     # Train the classifier by providing the dataset
-    knn.fit(data)
+    knn.fit_matrix(features, labels, image_size, norms)
 
     # Create an RGBImage object of the tested image
     test_img = img_read_helper(test_img_path)
@@ -885,3 +3591,64 @@ def knn_tests(test_img_path):
 """
 
 """
+
+
+# --------------------------------------------------------------------------- #
+
+def _parse_cli_operation(text):
+    """
+    Turns "name:arg:arg" from the command line into an operation, reading
+    each argument as a Python literal where possible
+    (e.g. "adjust_brightness:40" or "chroma_key:back.png:255,255,255")
+    """
+    name, *args = text.split(":")
+    parsed = []
+    for arg in args:
+        try:
+            parsed.append(ast.literal_eval(arg))
+        except (ValueError, SyntaxError):
+            parsed.append(arg)
+    return (name,) + tuple(parsed) if parsed else name
+
+
+def main(argv=None):
+    """
+    Command line entry point for batch processing, e.g.
+
+        python Code.py img/ img/out/ -o grayscale -o adjust_brightness:40 -o blur
+    """
+    parser = argparse.ArgumentParser(
+        description="Apply a chain of image operations to many image files")
+    parser.add_argument("inputs", help="input directory or glob pattern")
+    parser.add_argument("output_dir", help="directory to write the results to")
+    parser.add_argument("-o", "--operation", action="append", default=[],
+                        dest="operations", type=_parse_cli_operation,
+                        help="operation as name[:arg[:arg]], may be repeated")
+    parser.add_argument("--tier", choices=sorted(PROCESSOR_TIERS), default="standard")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    def progress(done, total, result):
+        if result["error"] is None:
+            print("[%d/%d] %s -> %s (cost %d)" % (done, total, result["input"],
+                                                result["output"], result["cost"]))
+        else:
+            print("[%d/%d] %s FAILED %s" % (done, total, result["input"], result["error"]))
+
+    try:
+        _parse_batch_operations(args.operations, args.tier)
+    except (TypeError, ValueError):
+        parser.error("invalid operation chain")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    summary = batch_process(args.inputs, args.operations, args.output_dir,
+                            tier=args.tier, workers=args.workers, progress=progress)
+    print("%d processed, %d failed, total cost %d" % (
+        len(summary["results"]) - summary["failed"], summary["failed"], summary["cost"]))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())